@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# Compare loading a schema from the binary tree format with parsing it,
+# and with unpickling the same tree.
+import io, pickle, sys, timeit, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import rnc2rng # noqa: E402
+from schemas import schema # noqa: E402
+
+def main(n=5):
+
+    src = schema(5000)
+    root = rnc2rng.loads(src)
+    buf = io.BytesIO()
+    rnc2rng.dump_ast(root, buf)
+    data = buf.getvalue()
+    blob = pickle.dumps(root, pickle.HIGHEST_PROTOCOL)
+    assert rnc2rng.dumps(rnc2rng.binary.loads(data)) == rnc2rng.dumps(root)
+
+    sizes = len(src), len(data), len(blob)
+    print('source: %d bytes, binary: %d bytes, pickle: %d bytes' % sizes)
+    cases = [
+        ('parse', lambda: rnc2rng.loads(src)),
+        ('unpickle', lambda: pickle.loads(blob)),
+        ('load_ast', lambda: rnc2rng.binary.loads(data)),
+        ('pickle', lambda: pickle.dumps(root, pickle.HIGHEST_PROTOCOL)),
+        ('dump_ast', lambda: rnc2rng.binary.dumps(root)),
+    ]
+    for name, fn in cases:
+        secs = min(timeit.repeat(fn, number=1, repeat=n))
+        print('%-10s %8.2f ms' % (name, secs * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# Compare the single-pass scanner with the rply LexerGenerator-based lexer
+# it replaced, both for throughput and for an identical token stream.
+import glob, sys, timeit, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from rnc2rng import parser # noqa: E402
+import rply # noqa: E402
+
+def rply_lexer():
+    lg = rply.LexerGenerator()
+    for name, regex in parser.RULES:
+        if name == 'WS':
+            lg.ignore(regex)
+        elif name != 'ERROR':
+            lg.add(name, regex)
+    return lg.build()
+
+RPLY_LEXER = rply_lexer()
+
+def rply_lex(src):
+    for t in RPLY_LEXER.lex(src):
+        if t.name == 'ID' and t.value in parser.KEYWORDS:
+            t.name = t.value.upper()
+        elif t.name == 'LITERAL':
+            t.value = t.value[1:-1]
+        elif t.name == 'COMMENT':
+            continue
+        yield t
+
+def tokens(lex, src):
+    return [(t.name, t.value, t.source_pos.lineno, t.source_pos.colno) for t in lex(src)]
+
+def main(n=5):
+
+    tests = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests')
+    sources = []
+    for fn in sorted(glob.glob(os.path.join(tests, '*.rnc'))):
+        with open(fn, 'rb') as f:
+            src = f.read()
+        if src[:2] in (parser.BOM_UTF16_BE, parser.BOM_UTF16_LE):
+            continue
+        sources.append(src.decode('utf-8'))
+
+    for src in sources:
+        assert tokens(parser.lex, src) == tokens(rply_lex, src)
+
+    corpus = '\n'.join(sources) * 200
+    size = len(corpus) / 1024.0 / 1024.0
+    for name, lex in [('rply', rply_lex), ('scanner', parser.lex)]:
+        secs = min(timeit.repeat(lambda: sum(1 for t in lex(corpus)), number=1, repeat=n))
+        print('%-8s %6.3f s  %6.2f MB/s' % (name, secs, size / secs))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# Report the memory taken by a large parsed tree, with and without sharing
+# identical subtrees (see the hashcons module), and as a flat tree.
+import gc, sys, os, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import rnc2rng # noqa: E402
+from rnc2rng import hashcons # noqa: E402
+from rnc2rng.parser import Node # noqa: E402
+from schemas import schema # noqa: E402
+
+def count(root):
+    # all nodes in the tree, and the distinct node objects among them
+    n, seen, stack = 0, set(), [root]
+    while stack:
+        node = stack.pop()
+        n += 1
+        seen.add(id(node))
+        stack.extend(c for c in node.value if isinstance(c, Node))
+    return n, len(seen)
+
+def measure(src, intern):
+    # memory still allocated after parsing, with the tree kept alive
+    gc.collect()
+    tracemalloc.start()
+    root = rnc2rng.loads(src, intern=intern)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return root, size
+
+def main():
+
+    src = schema(10000)
+    plain, plain_size = measure(src, None)
+    shared, shared_size = measure(src, True)
+    assert rnc2rng.dumps(shared) == rnc2rng.dumps(plain)
+
+    for name, root, size in (('plain', plain, plain_size), ('interned', shared, shared_size)):
+        nodes, distinct = count(root)
+        print('%-9s %8d nodes, %8d distinct: %8.2f MB, %6.1f bytes/node' % (
+            name, nodes, distinct, size / 1e6, size / nodes
+        ))
+    print('saved %.1f%%' % (100.0 * (plain_size - shared_size) / plain_size))
+
+    # the same tree as arrays (see the flat module)
+    gc.collect()
+    tracemalloc.start()
+    tree = rnc2rng.flatten(plain)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert rnc2rng.dumps(tree) == rnc2rng.dumps(plain)
+    print('flat      %8d items:                     %8.2f MB, %6.1f bytes/node' % (
+        len(tree), size / 1e6, size / len(tree)
+    ))
+
+    # sharing subtrees between schemas, through one interner
+    interner = hashcons.Interner()
+    for i in range(5):
+        rnc2rng.loads(schema(1000), intern=interner)
+    print('interner for 5 schemas: %(nodes)d nodes, %(distinct)d distinct' % interner.stats())
+
+if __name__ == '__main__':
+    main()
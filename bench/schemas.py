@@ -0,0 +1,16 @@
+# Generated schemas shared by the benchmarks.
+
+DEFINE = '''
+## Definition %(i)s
+d%(i)s = element e%(i)s {
+  attribute id { xsd:ID },
+  attribute kind { "a" | "b" | "c" }?,
+  attribute lang { xsd:language }?,
+  (text | empty | d%(j)s | element x:v%(i)s { xsd:string { maxLength = "10" } })*
+}
+'''
+
+def schema(n):
+    '''A schema with `n` definitions, each referring to the next one.'''
+    defines = ''.join(DEFINE % {'i': i, 'j': (i + 1) % n} for i in range(n))
+    return 'namespace x = "urn:x"\nstart = d0\n' + defines
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# Measure serialization cost per node on wide trees (many definitions) and
+# deep trees (nested elements), and building an ElementTree directly.
+import sys, timeit, os
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import rnc2rng # noqa: E402
+from rnc2rng.parser import Node # noqa: E402
+from schemas import schema # noqa: E402
+
+def wide(n):
+    return rnc2rng.loads(schema(n))
+
+def deep(depth):
+    node = Node('EMPTY', None)
+    for i in range(depth):
+        node = Node('ELEM', None, [Node('NAME', 'e%d' % i), node])
+    return Node('ROOT', None, [Node('DEFINE', 'start', [Node('ASSIGN', '='), node])])
+
+def count(root):
+    n, stack = 0, [root]
+    while stack:
+        node = stack.pop()
+        n += 1
+        stack.extend(c for c in node.value if isinstance(c, Node))
+    return n
+
+def main(n=5):
+
+    cases = [('wide', wide(2000)), ('deep 500', deep(500)), ('deep 2000', deep(2000))]
+    for name, root in cases:
+        nodes = count(root)
+        try:
+            secs = min(timeit.repeat(lambda: rnc2rng.dumps(root), number=1, repeat=n))
+        except RecursionError:
+            print('%-10s %7d nodes: recursion limit exceeded' % (name, nodes))
+            continue
+        print('%-10s %7d nodes: %8.2f ms, %6.2f us/node' % (
+            name, nodes, secs * 1000, secs * 1e6 / nodes
+        ))
+
+    # serializing a tree with names resolved beforehand, which measures the
+    # serializer on its own
+    root = cases[0][1]
+    resolved = rnc2rng.resolve_names(root)
+    names = min(timeit.repeat(lambda: rnc2rng.resolve_names(root), number=1, repeat=n))
+    dumps = min(timeit.repeat(lambda: rnc2rng.dumps(resolved), number=1, repeat=n))
+    print('resolve_names: %8.2f ms, dumps(resolved): %8.2f ms' % (names * 1000, dumps * 1000))
+
+    # serializing a flat tree (see the flat module), through views of its
+    # nodes, without building a resolved copy of the tree
+    tree = rnc2rng.flatten(root)
+    secs = min(timeit.repeat(lambda: rnc2rng.dumps(tree), number=1, repeat=n))
+    print('dumps(flat): %8.2f ms' % (secs * 1000))
+
+    # building an element tree directly, versus parsing the text output
+    direct = min(timeit.repeat(lambda: rnc2rng.to_etree(root), number=1, repeat=n))
+    reparse = min(timeit.repeat(lambda: ET.fromstring(rnc2rng.dumps(root)), number=1, repeat=n))
+    print('to_etree: %8.2f ms, dumps + fromstring: %8.2f ms' % (direct * 1000, reparse * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# Measure parser setup cost: loading the precompiled LALR tables versus
+# rebuilding them from the grammar (as done on every import before).
+import subprocess, sys, timeit, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from rnc2rng import parser # noqa: E402
+
+def main(n=20):
+
+    load = min(timeit.repeat(parser.build, number=1, repeat=n))
+    rebuild = min(timeit.repeat(lambda: parser.tables(parser.build_grammar()), number=1, repeat=n))
+    print('load tables:    %7.2f ms' % (load * 1000))
+    print('rebuild tables: %7.2f ms' % (rebuild * 1000))
+
+    cmd = [sys.executable, '-c', 'import rnc2rng']
+    cwd = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    run = lambda: subprocess.check_call(cmd, cwd=cwd)
+    print('import rnc2rng: %7.2f ms' % (min(timeit.repeat(run, number=1, repeat=n)) * 1000))
+
+if __name__ == '__main__':
+    main()
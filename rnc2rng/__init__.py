@@ -1,13 +1,114 @@
-from . import parser, serializer
+from . import binary, flat, hashcons, names, parser, serializer, simplification
 
-def load(f):
-    return parser.parse(f=f)
+import importlib
 
-def loads(src):
-    return parser.parse(src)
+# Modules (and names from them) that are only imported when first used,
+# to keep `import rnc2rng` fast.
+LAZY = {
+    'cache': 'cache',
+    'DiskCache': 'cache',
+    'MemoryCache': 'cache',
+    'fetch': 'fetch',
+    'Fetcher': 'fetch',
+    'watch': 'watch',
+}
 
-def dump(root, f, indent=None):
-    f.write(serializer.XMLSerializer(indent).toxml(root))
+def __getattr__(name):
+    if name not in LAZY:
+        raise AttributeError('module %r has no attribute %r' % (__name__, name))
+    module = importlib.import_module('.' + LAZY[name], __name__)
+    return module if name == LAZY[name] else getattr(module, name)
 
-def dumps(root, indent=None):
-    return serializer.XMLSerializer(indent).toxml(root)
+def load(f, cache_dir=None, cache=None, fetch=None, workers=None, intern=None):
+    '''Parse the schema in file `f` (a file name, URL or file object). If
+    `cache_dir` is given, parsed trees for file names are cached there
+    across processes (see `DiskCache`); `cache` may be a `MemoryCache` to
+    memoize results within the process instead. Files are read through
+    `fetch` (see `fetch.Fetcher`) if given. Otherwise, passing `workers`
+    parses included files in parallel on that many processes (see the
+    `parallel` module). If `intern` is true, identical subtrees of the
+    result share one instance; pass a `hashcons.Interner` to share them
+    with other trees as well.'''
+    if workers and fetch is None and cache is None and cache_dir is None:
+        if isinstance(f, parser.str_types):
+            from . import parallel
+            return interned(parallel.load(f, workers), intern)
+    fetch = fetch if fetch is not None else parser.read
+    if cache is not None and isinstance(f, parser.str_types):
+        root = cache.load(f, fetch)
+    elif cache_dir is not None and isinstance(f, parser.str_types):
+        from .cache import DiskCache
+        root = DiskCache(cache_dir).load(f, fetch)
+    else:
+        root = parser.parse(f=f, includes=parser.Includes(fetch))
+    return interned(root, intern)
+
+async def aload(fn, limit=8, fetch=None):
+    '''Asynchronous version of `load()` for file names and URLs, which
+    fetches included files concurrently (see the `aio` module).'''
+    from . import aio # avoid importing asyncio unless needed
+    return await aio.aload(fn, limit, fetch if fetch is not None else parser.read)
+
+def loads(src, cache=None, intern=None):
+    root = cache.loads(src) if cache is not None else parser.parse(src)
+    return interned(root, intern)
+
+def interned(root, intern):
+    if not intern:
+        return root
+    return hashcons.intern(root, intern if isinstance(intern, hashcons.Interner) else None)
+
+def flatten(root):
+    '''Convert the tree `root` to a `flat.FlatTree`, which stores the nodes
+    in a few arrays rather than as objects. Flat trees can be serialized
+    directly; use their `to_node()` method to get a Node tree back.'''
+    return flat.flatten(root)
+
+def resolve_names(root, annotations=True):
+    '''Resolve the qualified names in the tree `root` to namespace URIs and
+    local names (see the `names` module), in a copy of the tree. Serializing
+    the result skips that work, so this is useful for trees that are
+    serialized more than once; serializing other trees resolves their
+    names without copying them. Documentation and annotations are left
+    out unless `annotations` is true.'''
+    return names.resolve(root, annotations)
+
+def simplify(root):
+    '''Simplify the tree `root` as described in section 4 of the RELAX NG
+    specification (see the `simplification` module). The result is a
+    tree with resolved names, like that of `resolve_names()`.'''
+    return simplification.simplify(root)
+
+def dump(root, f, indent=None, cache=None, compact=False, annotations=True):
+    if cache is not None:
+        f.write(cache.dumps(root, indent, compact, annotations))
+    else:
+        serializer.XMLSerializer(indent, compact, annotations).dump(root, f)
+
+def dumps(root, indent=None, cache=None, compact=False, annotations=True):
+    '''Serialize `root` to RELAX NG XML syntax; see `XMLSerializer` for the
+    `compact` and `annotations` options.'''
+    if cache is not None:
+        return cache.dumps(root, indent, compact, annotations)
+    return serializer.XMLSerializer(indent, compact, annotations).toxml(root)
+
+def events(root, compact=False, annotations=True):
+    '''Generate a stream of ('start', tag, attrs), ('text', text) and
+    ('end', tag) events for the XML output for `root`, without building it
+    (see `serializer.Visitor`).'''
+    return serializer.events(root, compact, annotations)
+
+def to_etree(root, annotations=True):
+    '''Build an `xml.etree.ElementTree` element for the grammar `root`, with
+    the same structure as the output of `dumps()` (see the `etree`
+    module).'''
+    from . import etree # avoid importing ElementTree unless needed
+    return etree.ETreeBuilder(annotations).toetree(root)
+
+def dump_ast(root, f):
+    '''Write the parsed tree `root` to binary file `f`, in the compact
+    format defined in the `binary` module.'''
+    binary.dump(root, f)
+
+def load_ast(f):
+    return binary.load(f)
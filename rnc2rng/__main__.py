@@ -1,22 +1,298 @@
 #!/usr/bin/env python
 from __future__ import print_function
 from . import parser, serializer
-import sys
+import glob, os, sys, time
+
+GLOB_CHARS = set('*?[')
+
+# Fetchers are kept around, so that batch mode workers reuse connections.
+FETCHERS = {}
+
+def fetcher(args):
+    key = args.http_cache, args.offline
+    if key not in FETCHERS:
+        from .fetch import Fetcher
+        FETCHERS[key] = Fetcher(args.http_cache, args.offline)
+    return FETCHERS[key]
+
+def convert(input, args, includes=None):
+    '''Convert `input` (a file name or file object), applying the caching
+    options from the command line arguments in `args`. After conversion,
+    `includes` (if given) lists the files the output depends on.'''
+    if includes is None:
+        includes = parser.Includes(fetcher(args))
+    if args.cache_dir and not args.no_cache and isinstance(input, str):
+        from .cache import DiskCache
+        root = DiskCache(args.cache_dir).load(input, includes=includes)
+    else:
+        root = parser.parse(f=input, includes=includes)
+    return xml_serializer(args).toxml(root)
+
+def xml_serializer(args):
+    return serializer.XMLSerializer(compact=args.compact, annotations=not args.no_annotations,
+                                    simplify=args.simplify)
+
+def write(fn, content, skip_unchanged=False):
+    '''Write `content` to file `fn`. With `skip_unchanged`, an existing file
+    with the same content is left alone, preserving its modification time.'''
+    if skip_unchanged:
+        try:
+            with open(fn) as f:
+                if f.read() == content:
+                    return
+        except (IOError, OSError, ValueError):
+            pass
+    with open(fn, 'w') as f:
+        f.write(content)
+
+def make_escape(fn):
+    return fn.replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ')
+
+def depfile(target, input, includes):
+    '''Format a make rule listing `input` and the local files it includes
+    as dependencies of `target`, with an empty rule for each included file
+    (so that make does not fail when one is removed).'''
+    input = parser.resolve(input)
+    deps = [input] + [fn for fn in includes.digests if fn != input and not parser.is_url(fn)]
+    rules = ['%s: %s' % (make_escape(target), ' '.join(make_escape(fn) for fn in deps))]
+    rules.extend('%s:' % make_escape(fn) for fn in deps[1:])
+    return '\n'.join(rules) + '\n'
+
+def rng_name(fn):
+    return os.path.splitext(fn)[0] + '.rng'
+
+def expand(paths):
+    '''Expand input arguments (files, glob patterns or directories, which
+    are searched recursively for .rnc files) to (input, output) pairs; the
+    output name is relative to the output directory.'''
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for fn in sorted(filenames):
+                    if fn.endswith('.rnc'):
+                        fn = os.path.join(dirpath, fn)
+                        yield fn, rng_name(os.path.relpath(fn, path))
+        elif GLOB_CHARS & set(path):
+            base = os.path.dirname(path)
+            while GLOB_CHARS & set(base):
+                base = os.path.dirname(base)
+            for fn in sorted(glob.glob(path, recursive=True)):
+                yield fn, rng_name(os.path.relpath(fn, base or os.curdir))
+        else:
+            yield path, rng_name(os.path.basename(path))
+
+def check_outputs(jobs):
+    '''Split (input, output) pairs into those to convert and (input, error)
+    pairs for inputs that have the same output file as another input (for
+    example, files with the same name given as separate arguments). An
+    input listed more than once is only converted once.'''
+    outputs = {}
+    for fn, out in jobs:
+        key = os.path.normcase(os.path.abspath(out))
+        outputs.setdefault(key, (out, {}))[1].setdefault(os.path.realpath(fn), fn)
+    unique, clashes = [], []
+    for out, inputs in outputs.values():
+        inputs = sorted(inputs.values())
+        if len(inputs) == 1:
+            unique.append((inputs[0], out))
+            continue
+        for fn in inputs:
+            others = ', '.join(other for other in inputs if other != fn)
+            clashes.append((fn, 'output file %s is also the output for %s' % (out, others)))
+    return unique, clashes
+
+def batch_job(input, output, args):
+    # Runs in a worker process for batch mode; returns the input file name,
+    # the time it took and an error message if the conversion failed.
+    start = time.time()
+    try:
+        xml = convert(input, args)
+        os.makedirs(os.path.dirname(output) or os.curdir, exist_ok=True)
+        write(output, xml + '\n', args.skip_unchanged)
+    except parser.ParseError as e:
+        return input, time.time() - start, 'parse error ' + e.msg
+    except Exception as e:
+        return input, time.time() - start, '%s: %s' % (type(e).__name__, e)
+    return input, time.time() - start, None
+
+def run(jobs, args):
+    if args.jobs == 1:
+        for fn, out in jobs:
+            yield batch_job(fn, out, args)
+        return
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(args.jobs or None) as pool:
+        futures = [pool.submit(batch_job, fn, out, args) for (fn, out) in jobs]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+def batch(args):
+
+    start = time.time()
+    jobs, clashes = check_outputs(
+        (fn, os.path.join(args.out_dir, out)) for (fn, out) in expand(args.paths)
+    )
+    times, errors = [], []
+    for fn, error in clashes:
+        errors.append(fn)
+        print('%s: %s' % (fn, error), file=sys.stderr)
+    for fn, secs, error in run(jobs, args):
+        times.append((secs, fn))
+        if error is not None:
+            errors.append(fn)
+            print('%s: %s' % (fn, error), file=sys.stderr)
+
+    converted = len(jobs) + len(clashes) - len(errors)
+    summary = '%d converted, %d failed in %.2fs' % (converted, len(errors), time.time() - start)
+    if times:
+        secs, fn = max(times)
+        summary += ' (%.2fs total, slowest %s: %.2fs)' % (sum(t[0] for t in times), fn, secs)
+    print(summary, file=sys.stderr)
+    return 1 if errors else 0
+
+def watch(args, jobs):
+    from .watch import Watcher
+
+    def report(fn, secs, error):
+        if error is None:
+            print('%s: converted in %.2fs' % (fn, secs), file=sys.stderr)
+        else:
+            print('%s: %s' % (fn, error), file=sys.stderr)
+
+    clashes = set()
+
+    def current():
+        # inputs with the same output are reported (once) and left alone
+        unique, errors = check_outputs(jobs())
+        for fn, error in errors:
+            if fn not in clashes:
+                clashes.add(fn)
+                report(fn, 0, error)
+        return unique
+
+    try:
+        writer = lambda fn, content: write(fn, content, args.skip_unchanged)
+        Watcher(fetcher(args), writer, xml_serializer(args)).watch(current, report)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def daemon_convert(input, args, includes):
+    # convert through the daemon, if one is running
+    from . import daemon
+    fallback = lambda fn: convert(fn, args, includes)
+    try:
+        return daemon.convert(
+            args.daemon, input, fallback=fallback, compact=args.compact,
+            annotations=not args.no_annotations, simplify=args.simplify,
+            cache_dir=None if args.no_cache else args.cache_dir,
+            http_cache=args.http_cache, offline=args.offline,
+        )
+    except daemon.ConversionError as e:
+        print(e.msg)
+        sys.exit(1)
+
+def job_count(value):
+    import argparse
+    n = int(value)
+    if n < 0:
+        raise argparse.ArgumentTypeError('must be 0 (one per CPU) or more, not %d' % n)
+    return n
 
 def main():
 
-    args = sys.argv[1:]
-    input = open(args[0]) if len(args) > 0 else sys.stdin
+    import argparse
+    ap = argparse.ArgumentParser(prog='rnc2rng')
+    ap.add_argument('paths', nargs='*', metavar='input [output]',
+                    help='input and output file (default: stdin and stdout); '
+                         'with --out-dir, any number of input files, directories or glob patterns')
+    ap.add_argument('--out-dir', metavar='DIR',
+                    help='convert all inputs, writing the output files to this directory')
+    ap.add_argument('-j', '--jobs', type=job_count, default=1,
+                    help='number of worker processes for --out-dir (0: one per CPU)')
+    ap.add_argument('-M', '--depfile', metavar='FILE',
+                    help='write a make rule listing the files the output depends on')
+    ap.add_argument('--skip-unchanged', action='store_true',
+                    help='do not rewrite output files whose content is unchanged')
+    ap.add_argument('--compact', action='store_true',
+                    help='write compact output, without indentation or line breaks')
+    ap.add_argument('--no-annotations', action='store_true',
+                    help='leave out documentation and annotations')
+    ap.add_argument('--simplify', action='store_true',
+                    help='simplify the grammar as specified in section 4 of the RELAX NG '
+                         'specification (leaves out annotations)')
+    ap.add_argument('--watch', action='store_true',
+                    help='keep converting whenever an input or included file changes')
+    ap.add_argument('--cache-dir', default=os.environ.get('RNC2RNG_CACHE_DIR'),
+                    help='cache parsed schemas in this directory '
+                         '(default: $RNC2RNG_CACHE_DIR)')
+    ap.add_argument('--no-cache', action='store_true',
+                    help='do not use the parse cache')
+    ap.add_argument('--http-cache', metavar='DIR',
+                    default=os.environ.get('RNC2RNG_HTTP_CACHE'),
+                    help='cache included files fetched over HTTP in this directory '
+                         '(default: $RNC2RNG_HTTP_CACHE)')
+    ap.add_argument('--offline', action='store_true',
+                    help='only use HTTP responses from the HTTP cache')
+    ap.add_argument('--serve', metavar='ADDRESS',
+                    help='run a conversion daemon on this Unix socket path, port or host:port')
+    ap.add_argument('--daemon', metavar='ADDRESS', default=os.environ.get('RNC2RNG_DAEMON'),
+                    help='convert through the daemon at this address if it is running '
+                         '(default: $RNC2RNG_DAEMON)')
+    args = ap.parse_args()
+
+    if args.serve is not None:
+        from . import daemon
+        try:
+            daemon.serve(args.serve, fetcher(args))
+        except ValueError as e:
+            ap.error(str(e))
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+    elif args.depfile is not None and (args.watch or args.out_dir is not None):
+        ap.error('--depfile cannot be used with --watch or --out-dir')
+    elif args.watch and args.out_dir is not None:
+        sys.exit(watch(args, lambda: [
+            (fn, os.path.join(args.out_dir, out)) for (fn, out) in expand(args.paths)
+        ]))
+    elif args.watch and len(args.paths) == 2:
+        sys.exit(watch(args, lambda: [tuple(args.paths)]))
+    elif args.watch:
+        ap.error('--watch needs an input and output file, or --out-dir')
+    elif args.out_dir is not None:
+        sys.exit(batch(args))
+    elif len(args.paths) > 2:
+        ap.error('at most one input and one output file without --out-dir')
+    elif args.depfile is not None and len(args.paths) < 2:
+        ap.error('--depfile needs an input and output file')
+
+    input = args.paths[0] if args.paths else sys.stdin
+    includes = parser.Includes(fetcher(args))
+    use_daemon = args.daemon and args.paths and args.depfile is None
+    if use_daemon:
+        from . import daemon
+        try:
+            daemon.address(args.daemon)
+        except ValueError as e:
+            ap.error(str(e))
+
     try:
-        xml = serializer.XMLSerializer().toxml(parser.parse(f=input))
+        if use_daemon:
+            xml = daemon_convert(input, args, includes)
+        else:
+            xml = convert(input, args, includes)
     except parser.ParseError as e:
         print('parse error ' + e.msg)
         sys.exit(1)
 
-    if len(args) > 1:
-        open(sys.argv[2], 'w').write(xml + '\n')
+    if len(args.paths) > 1:
+        write(args.paths[1], xml + '\n', args.skip_unchanged)
     else:
         print(xml)
+    if args.depfile is not None:
+        write(args.depfile, depfile(args.paths[1], input, includes), args.skip_unchanged)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,48 @@
+# asyncio API: fetches all files a schema includes concurrently, before
+# handing them to the (synchronous) parser.
+from . import parser
+
+import asyncio
+
+LIMIT = 8
+
+async def prefetch(fn, limit=LIMIT, fetch=parser.read):
+    '''Fetch `fn` and all files it (transitively) includes, with at most
+    `limit` fetches in flight at the same time. Returns a dict mapping each
+    path or URL, as the parser will compute it, to its contents.'''
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(limit)
+    docs, tasks = {}, {}
+
+    async def get(url):
+        async with semaphore:
+            try:
+                bytes = await loop.run_in_executor(None, fetch, url)
+            except (OSError, ValueError):
+                return # leave it to the parser to report the error
+        docs[url] = bytes
+        path = parser.base_path(url)
+        try:
+            hrefs = parser.include_hrefs(parser.decode(bytes))
+        except ValueError:
+            return
+        for href in hrefs:
+            schedule(parser.include_target(path, href))
+
+    def schedule(url):
+        if url not in tasks:
+            tasks[url] = asyncio.ensure_future(get(url))
+
+    schedule(fn)
+    while not all(t.done() for t in tasks.values()):
+        await asyncio.gather(*tasks.values())
+    return docs
+
+async def aload(fn, limit=LIMIT, fetch=parser.read):
+    '''Asynchronously parse the schema in file or URL `fn`, fetching all
+    included files concurrently. The result is the same tree `load()`
+    would return. Files the include scan missed are fetched on demand.'''
+    docs = await prefetch(fn, limit, fetch)
+    includes = parser.Includes(lambda url: docs[url] if url in docs else fetch(url))
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, parser.parse, None, fn, includes)
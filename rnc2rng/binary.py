@@ -0,0 +1,134 @@
+# Compact binary encoding of parsed Node trees, so that schemas can be
+# stored pre-parsed and loaded again without going through the parser.
+#
+# Layout (integers in the header are unsigned 32-bit little-endian):
+#
+#   magic (4 bytes), format version, CRC-32 of the node type names (so
+#     that data written with other node types is rejected)
+#   string table: number of strings, the UTF-8 byte length of each,
+#     followed by all string bytes concatenated
+#   items: number of items, then three columns with one entry per item,
+#     each column prefixed by its array typecode (B, H or I, whichever is
+#     the smallest that fits all entries in that column).
+#
+# Items are stored in post-order, i.e. every node follows its children:
+# the columns hold the node type (an index into NODE_TYPES, or STRING for
+# plain string values), the name (0 for None, else 1 + the index into the
+# string table) and the number of children.
+from .parser import Node, NODE_TYPES
+
+import array, struct, sys, zlib
+
+MAGIC = b'RNCT'
+VERSION = 2
+TYPES_CRC = zlib.crc32(' '.join(NODE_TYPES).encode('ascii'))
+
+STRING = len(NODE_TYPES)
+TYPE_CODES = dict((t, i) for (i, t) in enumerate(NODE_TYPES))
+
+def typecode(top):
+    # the smallest unsigned array typecode for values up to `top`
+    return 'B' if top < 1 << 8 else 'H' if top < 1 << 16 else 'I'
+
+def column(values):
+    code = typecode(max(values) if values else 0)
+    a = array.array(code, values)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return code.encode('ascii') + a.tobytes()
+
+def uncolumn(data, pos, count):
+    typecode = data[pos:pos + 1]
+    if typecode not in (b'B', b'H', b'I'):
+        raise ValueError('invalid tree data')
+    a = array.array(typecode.decode('ascii'))
+    end = pos + 1 + a.itemsize * count
+    a.frombytes(data[pos + 1:end])
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a, end
+
+def dumps(root):
+    strings, index = [], {}
+
+    def intern(s):
+        if s not in index:
+            index[s] = len(strings) + 1
+            strings.append(s)
+        return index[s]
+
+    types, names, counts = [], [], []
+    stack = [(root, False)]
+    while stack:
+        item, done = stack.pop()
+        if not isinstance(item, Node):
+            types.append(STRING)
+            names.append(intern(item))
+            counts.append(0)
+        elif done:
+            if item.type not in TYPE_CODES:
+                raise ValueError('cannot encode node type %r' % item.type)
+            types.append(TYPE_CODES[item.type])
+            names.append(0 if item.name is None else intern(item.name))
+            counts.append(len(item.value))
+        else:
+            stack.append((item, True))
+            stack.extend((n, False) for n in reversed(item.value))
+
+    encoded = [s.encode('utf-8', 'surrogatepass') for s in strings]
+    header = [VERSION, TYPES_CRC, len(encoded)] + [len(s) for s in encoded]
+    return b''.join([MAGIC, struct.pack('<%dI' % len(header), *header)] + encoded + [
+        struct.pack('<I', len(types)), column(types), column(names), column(counts),
+    ])
+
+def loads(data):
+    '''Decode a tree. Raises ValueError for anything but data written by
+    `dumps()` with the same node types.'''
+    if data[:4] != MAGIC:
+        raise ValueError('not an rnc2rng tree')
+    try:
+        version, crc, count = struct.unpack('<III', data[4:16])
+        if version != VERSION:
+            raise ValueError('unsupported tree format version %s' % version)
+        elif crc != TYPES_CRC:
+            raise ValueError('tree data written with other node types')
+
+        pos = 16 + 4 * count
+        strings = [None]
+        for ln in struct.unpack('<%dI' % count, data[16:pos]):
+            strings.append(sys.intern(data[pos:pos + ln].decode('utf-8', 'surrogatepass')))
+            pos += ln
+
+        size, = struct.unpack('<I', data[pos:pos + 4])
+    except struct.error:
+        raise ValueError('truncated tree data') from None
+    types, pos = uncolumn(data, pos + 4, size)
+    names, pos = uncolumn(data, pos, size)
+    counts, pos = uncolumn(data, pos, size)
+    if len(counts) != size:
+        raise ValueError('truncated tree data')
+    elif size and (max(types) > STRING or max(names) >= len(strings)):
+        raise ValueError('invalid tree data')
+
+    stack, node_types = [], NODE_TYPES
+    for code, name, count in zip(types, names, counts):
+        if code == STRING:
+            stack.append(strings[name])
+        elif count > len(stack):
+            raise ValueError('invalid tree data')
+        elif count:
+            value = stack[-count:]
+            del stack[-count:]
+            stack.append(Node(node_types[code], strings[name], value))
+        else:
+            stack.append(Node(node_types[code], strings[name]))
+
+    if len(stack) != 1:
+        raise ValueError('invalid tree data')
+    return stack[0]
+
+def dump(root, f):
+    f.write(dumps(root))
+
+def load(f):
+    return loads(f.read())
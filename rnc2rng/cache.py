@@ -0,0 +1,229 @@
+# Persistent cache of parsed schemas, for repeated conversions of the same
+# (mostly unchanged) files across processes.
+from . import binary, parser, serializer
+
+import collections, json, os, pickle, tempfile, threading, weakref
+
+# Bump this when the layout of cache entries changes.
+FORMAT = 3
+
+MAX_SIZE = 64 * 1024 * 1024
+
+def current(deps, fetch=parser.read):
+    '''Check that the files in `deps`, a list of (name, digest) pairs, still
+    have the same contents.'''
+    for dep, digest in deps:
+        try:
+            if parser.digest(fetch(dep)) != digest:
+                return False
+        except (IOError, OSError):
+            return False
+    return True
+
+def dependencies(includes, key=None):
+    return sorted((k, v) for (k, v) in includes.digests.items() if k != key)
+
+class DiskCache(object):
+    '''Stores parsed trees in the directory `path`. Entries are keyed on the
+    resolved file name and the hash of its contents; each entry records the
+    hashes of all files it includes, so a hit is only used if none of them
+    changed since. When the total size of the cache exceeds `max_size`
+    bytes, the least recently used entries are removed (down to 3/4 of
+    that, so that the directory is not scanned again on every write).
+
+    Entries hold a line of JSON with the dependencies and the hash of the
+    tree, followed by the tree in the format of the `binary` module, so
+    reading a cache directory shared with others cannot run any code, and
+    corrupt entries are ignored.'''
+
+    def __init__(self, path, max_size=MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.size = None # an estimate of the total size of the entries
+
+    def entry(self, fn, digest):
+        key = '%s\0%s\0%s' % (FORMAT, parser.resolve(fn), digest)
+        return os.path.join(self.path, parser.digest(key.encode('utf-8')) + '.tree')
+
+    def get(self, fn, fetch=parser.read, includes=None):
+        try:
+            digest = parser.digest(fetch(fn))
+            entry = self.entry(fn, digest)
+            with open(entry, 'rb') as f:
+                header = json.loads(f.readline().decode('utf-8'))
+                data = f.read()
+            # corrupt entries are misses as well
+            if parser.digest(data) != header['tree']:
+                return None
+            deps = [(dep, digest) for (dep, digest) in header['deps']]
+            if not current(deps, fetch):
+                return None
+            root = binary.loads(data)
+        except (IOError, OSError, ValueError, TypeError, KeyError):
+            return None
+
+        os.utime(entry, None)
+        if includes is not None:
+            includes.digests.update(deps)
+            includes.digests[parser.resolve(fn)] = digest
+        return root
+
+    def put(self, fn, root, includes):
+        key = parser.resolve(fn)
+        deps = dependencies(includes, key)
+        tree = binary.dumps(root)
+        header = {'deps': deps, 'tree': parser.digest(tree)}
+        data = json.dumps(header).encode('utf-8') + b'\n' + tree
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, self.entry(fn, includes.digests[key]))
+
+        # other processes may write to the cache as well, so the size is
+        # only an estimate; evict() finds the actual size
+        if self.size is None:
+            self.size = sum(e[1] for e in self.entries())
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.evict()
+
+    def entries(self):
+        # (mtime, size, file name) for all entries; other processes may be
+        # evicting concurrently, so ignore missing files
+        entries = []
+        for fn in os.listdir(self.path):
+            if not fn.endswith('.tree'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, fn))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fn))
+        return entries
+
+    def evict(self):
+        entries = self.entries()
+        size = sum(e[1] for e in entries)
+        if size > self.max_size:
+            for mtime, sz, fn in sorted(entries):
+                if size <= self.max_size * 3 // 4:
+                    break
+                try:
+                    os.remove(os.path.join(self.path, fn))
+                except OSError:
+                    pass
+                size -= sz
+        self.size = size
+
+    def load(self, fn, fetch=parser.read, includes=None):
+        '''Parse `fn` (or get it from the cache). If an `includes` registry
+        is given, it is used for parsing; either way, its `digests` will
+        list all files the tree depends on.'''
+        includes = includes if includes is not None else parser.Includes(fetch)
+        root = self.get(fn, includes.fetch, includes)
+        if root is None:
+            root = parser.parse(f=fn, includes=includes)
+            self.put(fn, root, includes)
+        return root
+
+class MemoryCache(object):
+    '''In-process LRU cache for `loads()`, `load()` and `dumps()` results,
+    bounded to `max_entries` entries and (optionally) `max_size` bytes.
+
+    Parsed trees are stored in pickled form and unpickled on every hit, so
+    that callers can freely modify the trees they get back. Entries for
+    schemas with includes are only used while the included files are
+    unchanged. The number of hits and misses is kept in `hits`/`misses`.
+    A cache can be shared between threads.
+
+    `dumps()` results are only cached for trees returned by `loads()` or
+    `load()`, keyed by the source they were parsed from; serialize a copy
+    of such a tree if it was modified.'''
+
+    def __init__(self, max_entries=128, max_size=None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # trees returned by parse() -> key and dependencies of their entry
+        self.sources = weakref.WeakKeyDictionary()
+
+    def get(self, key, fetch=parser.read):
+        entry = self.entry(key, fetch)
+        return entry[1] if entry is not None else None
+
+    def entry(self, key, fetch=parser.read):
+        # dependencies are checked without holding the lock, it reads files
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or not current(entry[0], fetch):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            self.hits += 1
+        return entry
+
+    def put(self, key, deps, value):
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key)[1])
+            self.entries[key] = deps, value
+            self.size += len(value)
+            while len(self.entries) > self.max_entries or self.over_size():
+                self.size -= len(self.entries.popitem(last=False)[1][1])
+
+    def over_size(self):
+        return bool(self.entries) and self.max_size is not None and self.size > self.max_size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = self.hits = self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.entries), 'size': self.size,
+            }
+
+    def parse(self, key, src=None, f=None, fetch=parser.read):
+        entry = self.entry(key, fetch)
+        if entry is not None:
+            deps, root = entry[0], pickle.loads(entry[1])
+        else:
+            includes = parser.Includes(fetch)
+            root = parser.parse(src, f, includes)
+            deps = dependencies(includes, parser.resolve(f) if f is not None else None)
+            self.put(key, deps, pickle.dumps(root, pickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            self.sources[root] = key, deps
+        return root
+
+    def loads(self, src):
+        # includes are resolved relative to the working directory
+        key = 'loads', os.getcwd(), parser.digest(src.encode('utf-8', 'surrogatepass'))
+        return self.parse(key, src=src)
+
+    def load(self, fn, fetch=parser.read):
+        key = 'load', parser.resolve(fn), parser.digest(fetch(fn))
+        return self.parse(key, f=fn, fetch=fetch)
+
+    def dumps(self, root, indent=None, compact=False, annotations=True):
+        with self.lock:
+            source = self.sources.get(root)
+        if source is None:
+            return serializer.XMLSerializer(indent, compact, annotations).toxml(root)
+        key = ('dumps', indent, compact, annotations) + source[0]
+        xml = self.get(key)
+        if xml is None:
+            xml = serializer.XMLSerializer(indent, compact, annotations).toxml(root)
+            self.put(key, source[1], xml)
+        return xml
@@ -0,0 +1,252 @@
+# Conversion daemon: a long-running process that keeps the parser and its
+# caches warm, serving conversion requests over a local socket.
+#
+# Requests and responses are JSON objects, each sent as a 4-byte
+# big-endian length followed by that many bytes of UTF-8 encoded JSON. A
+# request looks like {"input": "/abs/path.rnc", "indent": null}, with
+# optional "compact", "annotations" and "simplify" flags (see
+# XMLSerializer) and "cache_dir", "http_cache" and "offline" options (as
+# on the command line); the response is either {"output": "<?xml ..."} or
+# {"error": "message"}.
+# Clients may send any number of requests over one connection.
+#
+# The daemon only listens on the loopback interface, or on a Unix socket
+# that only its user can connect to, since it reads any file it is asked
+# to convert (and writes cache files where it is asked to). Any local user
+# can connect to a port on the loopback interface, so on TCP every request
+# must also carry a "token": a random secret that the daemon writes to a
+# file only its user can read (see `token_path()`).
+from . import parser, serializer
+from .watch import Watcher
+
+import hmac, ipaddress, json, os, secrets, socket, socketserver, struct, threading
+
+# Unix sockets are not available on all platforms (Windows, notably)
+UNIX = hasattr(socket, 'AF_UNIX') and hasattr(socketserver, 'ThreadingUnixStreamServer')
+
+def address(spec):
+    '''Parse a daemon address: a port number or host:port for TCP (on the
+    loopback interface by default), anything else is a Unix socket path.
+    Raises ValueError for hosts other than the loopback interface.'''
+    host, sep, port = spec.rpartition(':')
+    if spec.isdigit():
+        return '127.0.0.1', int(spec)
+    elif not sep or not port.isdigit() or '/' in spec:
+        return spec
+    elif host and not loopback(host):
+        raise ValueError('daemon address %s is not on the loopback interface' % spec)
+    return host or '127.0.0.1', int(port)
+
+def loopback(host):
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == 'localhost'
+
+def token_path(addr):
+    '''The file holding the token for the TCP daemon at `addr`, a (host,
+    port) pair, in the user's home directory.'''
+    host, port = addr
+    return os.path.join(os.path.expanduser('~'), '.rnc2rng', 'daemon-%s-%d' % (host, port))
+
+def write_token(path):
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    token = secrets.token_hex(32)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+    return token
+
+def read_token(addr):
+    try:
+        with open(token_path(addr)) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+def send(f, message):
+    data = json.dumps(message).encode('utf-8')
+    f.write(struct.pack('>I', len(data)) + data)
+    f.flush()
+
+def receive(f):
+    header = f.read(4)
+    if len(header) < 4:
+        return None
+    size, = struct.unpack('>I', header)
+    data = f.read(size)
+    if len(data) < size:
+        return None
+    return json.loads(data.decode('utf-8'))
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            request = receive(self.rfile)
+            if request is None:
+                break
+            elif not self.server.allowed(request):
+                send(self.wfile, {'error': 'missing or wrong daemon token'})
+                break
+            send(self.wfile, self.server.convert(request))
+
+class Server(object):
+    '''Mixin for socketserver classes, holding the state shared by all
+    requests: parsed included files are kept in a `Watcher`, which drops
+    them when the files change. Requests with their own HTTP fetching
+    options get a separate watcher for those. Conversions are serialized
+    with a lock, since that state is not thread-safe (and the work is
+    CPU-bound). If `token` is set, requests must carry it.'''
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def setup(self, fetch=None, token=None):
+        self.watcher = Watcher(fetch)
+        self.watchers = {(None, False): self.watcher}
+        self.lock = threading.Lock()
+        self.token = token
+
+    def allowed(self, request):
+        if self.token is None:
+            return True
+        token = request.get('token')
+        return isinstance(token, str) and hmac.compare_digest(token, self.token)
+
+    def convert(self, request):
+        with self.lock:
+            try:
+                key = request.get('http_cache'), request.get('offline', False)
+                if key not in self.watchers:
+                    from .fetch import Fetcher
+                    self.watchers[key] = Watcher(Fetcher(*key))
+                watcher = self.watchers[key]
+                watcher.invalidate(watcher.changed())
+                xml = serializer.XMLSerializer(
+                    request.get('indent'), request.get('compact', False),
+                    request.get('annotations', True), request.get('simplify', False),
+                )
+                if not request.get('cache_dir'):
+                    return {'output': watcher.convert(request['input'], xml)}
+                from .cache import DiskCache
+                cache = DiskCache(request['cache_dir'])
+                root = cache.load(request['input'], includes=watcher.includes)
+                watcher.track(request['input'], False)
+                return {'output': xml.toxml(root)}
+            except parser.ParseError as e:
+                return {'error': 'parse error ' + e.msg}
+            except Exception as e:
+                return {'error': '%s: %s' % (type(e).__name__, e)}
+
+class TCPServer(Server, socketserver.ThreadingTCPServer):
+    pass
+
+if UNIX:
+    class UnixServer(Server, socketserver.ThreadingUnixStreamServer):
+        pass
+
+def make_server(spec, fetch=None):
+    addr = address(spec)
+    if isinstance(addr, str) and not UNIX:
+        raise ValueError('Unix sockets are not supported here, use a port number')
+    elif isinstance(addr, str):
+        if os.path.exists(addr) and connect(spec) is None:
+            os.unlink(addr) # stale socket left by a previous daemon
+        umask = os.umask(0o177) # only accessible to the current user
+        try:
+            server = UnixServer(addr, Handler)
+        finally:
+            os.umask(umask)
+        server.setup(fetch)
+    else:
+        server = TCPServer(addr, Handler)
+        # the port is only known now if it was 0
+        server.token_file = token_path((addr[0], server.server_address[1]))
+        server.setup(fetch, write_token(server.token_file))
+    return server
+
+def serve(spec, fetch=None):
+    server = make_server(spec, fetch)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if isinstance(server.server_address, str):
+            os.unlink(server.server_address)
+        else:
+            os.unlink(server.token_file)
+
+def connect(spec, timeout=None):
+    '''Connect to the daemon at `spec`; returns None if there is no daemon
+    listening (or Unix sockets are not supported).'''
+    addr = address(spec)
+    if isinstance(addr, str) and not UNIX:
+        return None
+    family = socket.AF_UNIX if isinstance(addr, str) else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(addr)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+class ConversionError(Exception):
+
+    def __init__(self, msg):
+        self.msg = msg
+        Exception.__init__(self, msg)
+
+def convert(spec, fn, indent=None, fallback=None, compact=False, annotations=True,
+            simplify=False, cache_dir=None, http_cache=None, offline=False):
+    '''Convert file `fn` through the daemon listening on `spec`. If no daemon
+    is running, `fn` is converted in this process instead, by calling
+    `fallback(fn)` if given. Parsed trees are cached in `cache_dir` and
+    HTTP responses in `http_cache` (see `cache.DiskCache` and
+    `fetch.Fetcher`), if given. Raises ConversionError (or, when
+    converting in-process, ParseError) if the conversion fails.'''
+    addr = address(spec) if spec else None
+    token = read_token(addr) if isinstance(addr, tuple) else None
+    if isinstance(addr, tuple) and token is None:
+        sock = None # no daemon of this user on that port
+    else:
+        sock = connect(spec) if spec else None
+    if sock is None and fallback is not None:
+        return fallback(fn)
+    elif sock is None:
+        fetch = None
+        if http_cache is not None or offline:
+            from .fetch import Fetcher
+            fetch = Fetcher(http_cache, offline)
+        includes = parser.Includes(fetch)
+        if cache_dir is not None:
+            from .cache import DiskCache
+            root = DiskCache(cache_dir).load(fn, includes=includes)
+        else:
+            root = parser.parse(f=fn, includes=includes)
+        return serializer.XMLSerializer(indent, compact, annotations, simplify).toxml(root)
+
+    request = {
+        'input': os.path.abspath(fn), 'indent': indent,
+        'compact': compact, 'annotations': annotations, 'simplify': simplify,
+    }
+    # options are only sent if given, so that the daemon uses its own
+    # fetching options otherwise
+    if cache_dir is not None:
+        request['cache_dir'] = os.path.abspath(cache_dir)
+    if http_cache is not None:
+        request['http_cache'] = os.path.abspath(http_cache)
+    if offline:
+        request['offline'] = True
+    if token is not None:
+        request['token'] = token
+    with sock, sock.makefile('rwb') as f:
+        send(f, request)
+        response = receive(f)
+    if response is None:
+        raise ConversionError('no response from daemon at %s' % spec)
+    elif 'error' in response:
+        raise ConversionError(response['error'])
+    return response['output']
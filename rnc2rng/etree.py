@@ -0,0 +1,57 @@
+# Build xml.etree.ElementTree elements directly from a parsed tree, with
+# the same structure as the XML text written by XMLSerializer.
+from .serializer import NAMESPACES, Visitor
+
+import itertools
+import xml.etree.ElementTree as ET
+
+def build(chunks):
+    '''Build an element from events, given in `chunks` (lists of events,
+    see `serializer.Visitor.chunks()`). Element and attribute names use
+    ElementTree's {uri}local notation, resolving prefixes through the
+    `xmlns` attributes in scope. No whitespace is added between elements.'''
+    builder = ET.TreeBuilder()
+    # each scope maps prefixes to namespaces, and caches qualified names
+    scopes = [({'xml': NAMESPACES['xml']}, {})]
+    tags = []
+    for event in itertools.chain.from_iterable(chunks):
+        kind = event[0]
+        if kind == 'start':
+            scope, attrs = scopes[-1], event[2]
+            decls = [(k[6:], v) for (k, v) in attrs if k == 'xmlns' or k.startswith('xmlns:')]
+            if decls:
+                scope = dict(scope[0], **dict(decls)), {}
+            attrib = {}
+            for k, v in attrs:
+                if k == 'xmlns' or k.startswith('xmlns:'):
+                    continue
+                # unprefixed attributes are not in a namespace
+                attrib[qname(k, scope) if ':' in k else k] = v
+            tag = qname(event[1], scope)
+            builder.start(tag, attrib)
+            scopes.append(scope)
+            tags.append(tag)
+        elif kind == 'text':
+            builder.data(event[1])
+        else:
+            scopes.pop()
+            builder.end(tags.pop())
+    return builder.close()
+
+def qname(name, scope):
+    ns, cache = scope
+    if name not in cache:
+        prefix, sep, local = name.rpartition(':')
+        uri = ns.get(prefix)
+        cache[name] = '{%s}%s' % (uri, local) if uri else name
+    return cache[name]
+
+class ETreeBuilder(object):
+    '''Builds ElementTree elements for trees; `annotations` is as for
+    `XMLSerializer`.'''
+
+    def __init__(self, annotations=True):
+        self.visitor = Visitor(annotations=annotations)
+
+    def toetree(self, node):
+        return build(self.visitor.chunks(node))
@@ -0,0 +1,153 @@
+# Fetching of included files over HTTP, with persistent connections and an
+# on-disk response cache that is revalidated with conditional requests.
+from . import parser
+from urllib.parse import urljoin, urlparse
+
+import json, os, tempfile, threading
+
+MAX_REDIRECTS = 5
+
+class Fetcher(object):
+    '''A fetch function for `parser.Includes` (or the `fetch` argument of
+    `load()`). Local files and file: URLs are read directly. HTTP(S)
+    requests reuse one connection per host (and thread); if `cache_dir` is
+    given, responses are stored there and revalidated on later fetches
+    through their ETag/Last-Modified headers. In `offline` mode, cached
+    responses are used as-is and the network is never accessed.
+
+    Requests go through the proxies given as `proxies`, a dict mapping
+    URL schemes to proxy URLs, or by default those configured in the
+    environment (http_proxy, https_proxy and no_proxy), like urllib.'''
+
+    def __init__(self, cache_dir=None, offline=False, timeout=30, proxies=None):
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.timeout = timeout
+        self.proxies = proxies
+        self.local = threading.local()
+
+    def __call__(self, url):
+        if urlparse(url).scheme not in ('http', 'https'):
+            return parser.read(url)
+
+        meta, body = self.cached(url)
+        if self.offline:
+            if body is None:
+                raise IOError('%s is not cached (offline mode)' % url)
+            return body
+
+        headers = {'User-Agent': 'rnc2rng'}
+        if body is not None and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if body is not None and meta.get('last-modified'):
+            headers['If-Modified-Since'] = meta['last-modified']
+
+        from urllib.error import HTTPError
+        location = url
+        for i in range(MAX_REDIRECTS + 1):
+            rsp, data = self.request(location, headers)
+            if rsp.status in (301, 302, 303, 307, 308) and rsp.msg.get('Location'):
+                location = urljoin(location, rsp.msg['Location'])
+                continue
+            elif rsp.status == 304 and body is not None:
+                return body
+            elif rsp.status != 200:
+                raise HTTPError(location, rsp.status, rsp.reason, rsp.msg, None)
+            self.store(url, rsp.msg, data)
+            return data
+        raise HTTPError(url, rsp.status, 'too many redirects', rsp.msg, None)
+
+    def request(self, url, headers):
+        import http.client # only imported when needed, to speed up startup
+        u = urlparse(url)
+        key = u.scheme, u.netloc
+        path = (u.path or '/') + ('?' + u.query if u.query else '')
+        proxy = self.proxy(u)
+        if proxy is not None and u.scheme == 'http':
+            path = url # plain HTTP proxies take the full URL
+            headers = dict(headers, **self.proxy_headers(proxy))
+        connections = self.local.__dict__.setdefault('connections', {})
+        for attempt in range(2):
+            conn = connections.get(key)
+            reused = conn is not None
+            if conn is None:
+                conn = connections[key] = self.connect(u, proxy)
+            try:
+                conn.request('GET', path, headers=headers)
+                rsp = conn.getresponse()
+                data = rsp.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                del connections[key]
+                if reused and not attempt:
+                    continue # the server may have closed an idle connection
+                raise
+            if rsp.will_close:
+                conn.close()
+                del connections[key]
+            return rsp, data
+
+    def connect(self, u, proxy):
+        import http.client
+        cls = http.client.HTTPSConnection if u.scheme == 'https' else http.client.HTTPConnection
+        if proxy is None:
+            return cls(u.netloc, timeout=self.timeout)
+        conn = cls(proxy.hostname, proxy.port, timeout=self.timeout)
+        if u.scheme == 'https':
+            conn.set_tunnel(u.hostname, u.port, headers=self.proxy_headers(proxy))
+        return conn
+
+    def proxy(self, u):
+        # the proxy URL to use for the URL `u` (parsed), or None
+        from urllib.request import getproxies, proxy_bypass
+        if self.proxies is None:
+            self.proxies = getproxies()
+        proxy = self.proxies.get(u.scheme)
+        if not proxy or proxy_bypass(u.netloc):
+            return None
+        return urlparse(proxy if '://' in proxy else 'http://' + proxy)
+
+    def proxy_headers(self, proxy):
+        if proxy.username is None:
+            return {}
+        from base64 import b64encode
+        from urllib.parse import unquote
+        creds = '%s:%s' % (unquote(proxy.username), unquote(proxy.password or ''))
+        return {'Proxy-Authorization': 'Basic ' + b64encode(creds.encode('utf-8')).decode('ascii')}
+
+    def close(self):
+        for conn in self.local.__dict__.pop('connections', {}).values():
+            conn.close()
+
+    def entry(self, url):
+        return os.path.join(self.cache_dir, parser.digest(url.encode('utf-8')))
+
+    def cached(self, url):
+        if self.cache_dir is None:
+            return {}, None
+        entry = self.entry(url)
+        try:
+            with open(entry + '.json') as f:
+                meta = json.load(f)
+            with open(entry + '.body', 'rb') as f:
+                body = f.read()
+        except (IOError, OSError, ValueError):
+            return {}, None
+        if meta.get('url') != url or meta.get('digest') != parser.digest(body):
+            return {}, None
+        return meta, body
+
+    def store(self, url, msg, data):
+        if self.cache_dir is None:
+            return
+        meta = {
+            'url': url, 'digest': parser.digest(data),
+            'etag': msg.get('ETag'), 'last-modified': msg.get('Last-Modified'),
+        }
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry = self.entry(url)
+        for ext, content in (('.body', data), ('.json', json.dumps(meta).encode('utf-8'))):
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp, entry + ext)
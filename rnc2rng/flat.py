@@ -0,0 +1,146 @@
+# Array-backed trees: a compact alternative to trees of parser.Node objects
+# for keeping many parsed schemas in memory.
+#
+# A FlatTree holds its items (nodes and plain string values) in pre-order,
+# in three parallel arrays with one entry per item: the type (an index into
+# NODE_TYPES, or STRING for plain string values, as in the binary module),
+# the name (an index into `strings`, where entry 0 is None) and the end of
+# its subtree (the index just past its last descendant). The first child of
+# item i, if any, is at i + 1; the next sibling of item i is at ends[i].
+from .binary import STRING, TYPE_CODES, typecode
+from .parser import Node, NODE_TYPES
+
+import array, sys
+
+def column(values):
+    return array.array(typecode(max(values) if values else 0), values)
+
+class FlatTree(object):
+    '''A tree stored as columns of integers (see above). Use `from_node()`
+    to build one; the tree can be serialized like a Node tree. Nodes can be
+    inspected through `View` objects, from `root` or `view()`; serializers
+    visit those rather than building Node objects.'''
+
+    def __init__(self, types, names, ends, strings):
+        self.types = types
+        self.names = names
+        self.ends = ends
+        self.strings = strings
+
+    @classmethod
+    def from_node(cls, root):
+        strings, index = [None], {None: 0}
+        types, names, ends = [], [], []
+        stack = [root]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, int): # the end of the subtree at `item`
+                ends[item] = len(types)
+                continue
+
+            i = len(types)
+            if not isinstance(item, Node):
+                code, name = STRING, item
+            elif item.type not in TYPE_CODES:
+                raise ValueError('cannot encode node type %r' % item.type)
+            else:
+                code, name = TYPE_CODES[item.type], item.name
+            if name not in index:
+                index[name] = len(strings)
+                strings.append(sys.intern(name))
+            types.append(code)
+            names.append(index[name])
+            ends.append(i + 1)
+            if code != STRING and item.value:
+                stack.append(i)
+                stack.extend(reversed(item.value))
+        return cls(column(types), column(names), column(ends), strings)
+
+    def to_node(self, index=0):
+        '''Build a Node tree for the subtree at `index`.'''
+        types, names, ends, strings = self.types, self.names, self.ends, self.strings
+        # children come after their parent, so build items back to front
+        items = [None] * (ends[index] - index)
+        for i in range(ends[index] - 1, index - 1, -1):
+            if types[i] == STRING:
+                items[i - index] = strings[names[i]]
+                continue
+            value, j = [], i + 1
+            while j < ends[i]:
+                value.append(items[j - index])
+                j = ends[j]
+            items[i - index] = Node(NODE_TYPES[types[i]], strings[names[i]], value)
+        return items[0]
+
+    def __len__(self):
+        return len(self.types)
+
+    @property
+    def root(self):
+        return View(self, 0)
+
+    def view(self, index):
+        return View(self, index)
+
+    def nbytes(self):
+        '''The size of the columns in bytes (not counting the strings).'''
+        return sum(a.itemsize * len(a) for a in (self.types, self.names, self.ends))
+
+class View(object):
+    '''A read-only view of the node at `index` in `tree`, with the `type`,
+    `name` and `value` of a Node. Children are views as well (or strings);
+    `value` builds a list of them, `children()` iterates over them.'''
+
+    __slots__ = 'tree', 'index'
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    @property
+    def type(self):
+        return NODE_TYPES[self.tree.types[self.index]]
+
+    @property
+    def name(self):
+        return self.tree.strings[self.tree.names[self.index]]
+
+    @property
+    def value(self):
+        # the same as list(self.children()), but this is used a lot when
+        # serializing, so it is built in one go
+        tree = self.tree
+        types, names, ends, strings = tree.types, tree.names, tree.ends, tree.strings
+        value, i, end = [], self.index + 1, ends[self.index]
+        while i < end:
+            value.append(strings[names[i]] if types[i] == STRING else View(tree, i))
+            i = ends[i]
+        return value
+
+    def children(self):
+        tree = self.tree
+        i, end = self.index + 1, tree.ends[self.index]
+        while i < end:
+            if tree.types[i] == STRING:
+                yield tree.strings[tree.names[i]]
+            else:
+                yield View(tree, i)
+            i = tree.ends[i]
+
+    def to_node(self):
+        return self.tree.to_node(self.index)
+
+    def __eq__(self, other):
+        return isinstance(other, View) and self.tree is other.tree and self.index == other.index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    def __repr__(self):
+        return 'View(%s, %r)' % (self.type, self.name)
+
+def flatten(root):
+    return FlatTree.from_node(root)
@@ -0,0 +1,63 @@
+# Hash-consing for parsed trees: structurally identical subtrees (such as
+# the many `xsd:string`, `text` or `empty` nodes in generated schemas) are
+# replaced by a single shared instance, and names and literals are
+# interned, to reduce the memory taken by trees kept around.
+from . import parser
+
+import sys
+
+class Interner(object):
+    '''Keeps the canonical instance of every distinct subtree seen by
+    `intern()`, so that one interner can be used to share subtrees between
+    many trees. The number of nodes visited and the number of those found
+    to be duplicates are kept in `nodes`/`shared`.
+
+    Shared subtrees are the same objects, so trees that have been interned
+    must not be modified afterwards.'''
+
+    def __init__(self):
+        self.table = {}
+        self.nodes = 0
+        self.shared = 0
+
+    def intern(self, root):
+        '''Intern the tree `root`, replacing (in place) the children of its
+        nodes by their canonical instances. Returns the canonical instance
+        of `root` itself.'''
+        Node, table = parser.Node, self.table
+        # canonical instances of the nodes done so far (by id, since trees
+        # may already share nodes), from a post-order walk
+        done = {}
+        stack = [(root, False)]
+        while stack:
+            x, ready = stack.pop()
+            if id(x) in done:
+                continue
+            elif not ready:
+                stack.append((x, True))
+                stack.extend((n, False) for n in x.value if isinstance(n, Node))
+                continue
+
+            value = [
+                done[id(n)] if isinstance(n, Node) else
+                sys.intern(n) if isinstance(n, str) else n
+                for n in x.value
+            ]
+            name = sys.intern(x.name) if isinstance(x.name, str) else x.name
+            key = x.type, name, tuple(value)
+            self.nodes += 1
+            if key in table:
+                self.shared += 1
+            else:
+                x.name, x.value = name, value
+                table[key] = x
+            done[id(x)] = table[key]
+        return done[id(root)]
+
+    def stats(self):
+        return {'nodes': self.nodes, 'shared': self.shared, 'distinct': len(self.table)}
+
+def intern(root, interner=None):
+    '''Share the identical subtrees of `root` (see `Interner`), using
+    `interner` if given, to also share them with trees interned before.'''
+    return (interner if interner is not None else Interner()).intern(root)
@@ -0,0 +1,369 @@
+# Resolve the qualified names in a parsed tree to namespace URIs and local
+# names in one pass after parsing, so that serializers can use them as is.
+from . import flat, parser
+from .parser import (
+    ANNO_ATTR, ANNOTATION, ATTR, DATATAG, DATATYPES, DEFAULT_NS,
+    DOCUMENTATION, ELEM, LITERAL_TYPE, NAME, NS, ROOT
+)
+
+import collections, sys
+
+TYPELIBS = {
+    'xsd': 'http://www.w3.org/2001/XMLSchema-datatypes'
+}
+NAMESPACES = {
+    'a': 'http://relaxng.org/ns/compatibility/annotations/1.0',
+    'xml': 'http://www.w3.org/XML/1998/namespace',
+}
+
+DECLS = set([DATATYPES, DEFAULT_NS, NS])
+BUILTIN_TYPES = set(['string', 'token'])
+
+# Node types for which `Resolver.copy()` does more than copying.
+COPIED = set([
+    ANNO_ATTR, ANNOTATION, ATTR, DATATAG, DOCUMENTATION, ELEM, LITERAL_TYPE,
+    NAME, ROOT
+])
+
+class QName(collections.namedtuple('QName', 'uri local prefix')):
+    '''A resolved name: the namespace (or datatype library) URI, the local
+    name and the prefix it was written with (None if unprefixed). For
+    `anyName`, the URI is None and the local name is `*`; for `nsName`, the
+    local name is `*`.'''
+
+    __slots__ = ()
+
+    def __str__(self):
+        return self.local if self.prefix is None else self.prefix + ':' + self.local
+
+class Resolved(parser.Node):
+    '''The root of a resolved tree. It starts with the declarations for the
+    grammar element: the default namespace (if any), then all namespace
+    prefixes and datatype libraries used or declared anywhere in the tree,
+    including in included files. Other declarations are left out.
+    `anno_prefixes` holds the prefixes among those that are only declared
+    for annotations, so that they can be left out with the annotations.'''
+
+    __slots__ = 'anno_prefixes',
+
+    def __init__(self, type, name, value=None, anno_prefixes=()):
+        parser.Node.__init__(self, type, name, value)
+        self.anno_prefixes = frozenset(anno_prefixes)
+
+class ResolveError(parser.ParseError):
+    '''Raised for names with an undeclared prefix, and for conflicting
+    namespace declarations. These are found after parsing; the location is
+    that of the first use of the prefix (or its declaration) in the
+    document, if the parser recorded it (see `parser.Root`).'''
+
+    def __init__(self, msg, location=None):
+        if location is None:
+            self.token = self.location = self.line = None
+            self.msg = msg
+            Exception.__init__(self, msg)
+            return
+        parser.ParseError.__init__(self, None, *location)
+        self.msg = '%s\n%s' % (msg, self.msg)
+        self.args = self.msg,
+
+class Scope(object):
+    '''The declarations that apply to the names in a (possibly included)
+    document, and the names resolved in it so far. Errors are located
+    through the root of the document, if it is a `parser.Root`.'''
+
+    def __init__(self, ns, typelibs, default, root=None):
+        self.ns = ns
+        self.typelibs = typelibs
+        self.default = default
+        self.root = root if isinstance(root, parser.Root) else None
+        self.names = {}
+
+    def locate(self, kind, prefix):
+        return None if self.root is None else self.root.locate((kind, prefix))
+
+class Resolver(object):
+    '''Resolves the names in trees. Unprefixed element names are in the
+    default namespace of their document; unprefixed attribute names are in
+    no namespace. Included documents may declare their own default
+    namespace, but a prefix must have the same namespace everywhere, since
+    all prefixes are declared on the one grammar element. Documentation and
+    annotations are left out unless `annotations` is true.
+
+    Use `resolve()` to get a copy of a tree with its names resolved, or
+    `scan()` to resolve the names of a tree without copying it, and look
+    them up again while visiting it.'''
+
+    def __init__(self, annotations=True):
+        self.annotations = annotations
+        self.skipped = DECLS if annotations else DECLS | set([
+            ANNOTATION, ANNO_ATTR, DOCUMENTATION
+        ])
+
+    def begin(self):
+        # prefixes and datatype libraries to declare on the grammar element
+        self.ns, self.typelibs, self.builtins = {}, {}, set()
+        self.annotated = set() # builtin prefixes used in annotations
+        self.qnames = {}
+        self.default = None
+
+    def declarations(self):
+        '''The declarations for the grammar element, after resolving.'''
+        self.anno_prefixes = self.annotated - self.builtins - set(self.ns)
+        for prefix in self.builtins | self.annotated:
+            self.ns.setdefault(prefix, NAMESPACES[prefix])
+        Node = parser.Node
+        decls = [] if self.default is None else [Node(DEFAULT_NS, None, [self.default])]
+        decls.extend(Node(NS, k, [v]) for (k, v) in sorted(self.ns.items()))
+        decls.extend(Node(DATATYPES, k, [v]) for (k, v) in sorted(self.typelibs.items()))
+        return decls
+
+    def resolve(self, root):
+        '''Resolve the names in `root`, a tree of `parser.Node` objects or a
+        `flat.FlatTree`.'''
+        if isinstance(root, Resolved):
+            return root
+        self.begin()
+        if isinstance(root, flat.FlatTree):
+            result = self.copy_flat(root)
+        else:
+            result = self.copy_nodes(root)
+        result.value[:0] = self.declarations()
+        result.anno_prefixes = frozenset(self.anno_prefixes)
+        return result
+
+    def scan(self, root):
+        '''Resolve the names in `root` (a tree of `parser.Node` objects or a
+        `flat.FlatTree`) without copying it. The scope of each included
+        document is kept in `scopes`, keyed by its root node (or view) and
+        the scope it is included from (since shared subtrees may be
+        included from several), to look up the resolved names while
+        visiting the tree with `name()` and `datatype()`; the scope of
+        `root` itself is returned. The datatype libraries used are counted
+        in `libraries`.'''
+        self.begin()
+        self.scopes = {}
+        self.libraries = collections.Counter()
+        if isinstance(root, flat.FlatTree):
+            return self.scan_flat(root)
+        return self.scan_nodes(root)
+
+    # Names are resolved in document order, which is the order in which
+    # datatype libraries are first counted (`most_common()` keeps it for
+    # ties), and the order in which errors are found.
+
+    def scan_nodes(self, root):
+        top = self.enter(root, Scope({}, {}, None), True)
+        Node, skipped = parser.Node, self.skipped
+        stack = [(iter(root.value), None, top)]
+        while stack:
+            children, ctx, scope = stack[-1]
+            for n in children:
+                if not isinstance(n, Node) or n.type in skipped:
+                    continue
+                inner, s = ctx, scope
+                if n.type in COPIED:
+                    inner, s = self.find(n.type, n.name, ctx, scope, n)
+                if n.value:
+                    stack.append((iter(n.value), inner, s))
+                    break
+            else:
+                stack.pop()
+        return top
+
+    def scan_flat(self, tree):
+        # the same, reading the columns of a flat tree: its items are in
+        # document order already, so the stack only holds the end, context
+        # and scope of the nodes containing item i
+        top = self.enter(tree.root, Scope({}, {}, None), True)
+        types, names, ends, strings = tree.types, tree.names, tree.ends, tree.strings
+        node_types, skipped = parser.NODE_TYPES, self.skipped
+        stack = [(ends[0], None, top)]
+        i = 1
+        while i < ends[0]:
+            while i >= stack[-1][0]:
+                stack.pop()
+            code = types[i]
+            if code == flat.STRING or node_types[code] in skipped:
+                i = ends[i]
+                continue
+            t = node_types[code]
+            end, ctx, scope = stack[-1]
+            if t in COPIED:
+                view = tree.view(i) if t == ROOT else None
+                ctx, scope = self.find(t, strings[names[i]], ctx, scope, view)
+            if ends[i] > i + 1:
+                stack.append((ends[i], ctx, scope))
+            i += 1
+        return top
+
+    def find(self, t, name, ctx, scope, node):
+        # Resolves the name of a node of type `t` (see `copy()`), returning
+        # the context and scope for its children.
+        if t == NAME:
+            self.name(name, ctx, scope)
+        elif t == ELEM or t == ATTR:
+            ctx = t
+        elif t == DATATAG or t == LITERAL_TYPE:
+            self.libraries[self.datatype(name, scope).uri] += 1
+        elif t == ANNOTATION or t == ANNO_ATTR:
+            self.name(name, ANNOTATION, scope)
+        elif t == DOCUMENTATION:
+            self.annotated.add('a')
+        elif t == ROOT:
+            self.scopes[node, scope] = self.enter(node, scope)
+            scope = self.scopes[node, scope]
+        return ctx, scope
+
+    # Children are copied (and their names resolved) when visiting their
+    # parent, so that only nodes with children go on the stack.
+
+    def copy_nodes(self, root):
+        scope = self.enter(root, Scope({}, {}, None), True)
+        result = Resolved(ROOT, None)
+        Node, skipped = parser.Node, self.skipped
+        stack = [(root, None, scope, result)]
+        while stack:
+            x, ctx, scope, copy = stack.pop()
+            out = copy.value
+            for n in x.value:
+                if not isinstance(n, Node):
+                    out.append(n)
+                elif n.type in skipped:
+                    continue
+                elif n.type in COPIED:
+                    y, inner, s = self.copy(n.type, n.name, ctx, scope, n)
+                    out.append(y)
+                    if n.value:
+                        stack.append((n, inner, s, y))
+                else:
+                    y = Node(n.type, n.name)
+                    out.append(y)
+                    if n.value:
+                        stack.append((n, ctx, scope, y))
+        return result
+
+    def copy_flat(self, tree):
+        # the same, reading the columns of a flat tree
+        scope = self.enter(tree.root, Scope({}, {}, None), True)
+        result = Resolved(ROOT, None)
+        types, names, ends, strings = tree.types, tree.names, tree.ends, tree.strings
+        node_types, skipped = parser.NODE_TYPES, self.skipped
+        stack = [(0, None, scope, result)]
+        while stack:
+            i, ctx, scope, copy = stack.pop()
+            out = copy.value
+            i, end = i + 1, ends[i]
+            while i < end:
+                code = types[i]
+                if code == flat.STRING:
+                    out.append(strings[names[i]])
+                elif node_types[code] not in skipped:
+                    view = tree.view(i) if node_types[code] == ROOT else None
+                    y, inner, s = self.copy(node_types[code], strings[names[i]], ctx, scope, view)
+                    out.append(y)
+                    if ends[i] > i + 1:
+                        stack.append((i, inner, s, y))
+                i = ends[i]
+        return result
+
+    def copy(self, t, name, ctx, scope, node):
+        # Returns a copy (without children) of a node of type `t`, with its
+        # name resolved, and the context and scope for its children. The
+        # node itself is only used for included documents.
+        if t == NAME:
+            name = self.name(name, ctx, scope)
+        elif t == ELEM or t == ATTR:
+            ctx = t # the context for names in the name class
+        elif t == DATATAG or t == LITERAL_TYPE:
+            name = self.datatype(name, scope)
+        elif t == ANNOTATION or t == ANNO_ATTR:
+            name = self.name(name, ANNOTATION, scope)
+        elif t == DOCUMENTATION:
+            self.annotated.add('a')
+        elif t == ROOT:
+            scope = self.enter(node, scope)
+        return parser.Node(t, name), ctx, scope
+
+    def enter(self, root, parent, top=False):
+        # the scope for the document `root`, included from scope `parent`
+        scope = Scope(dict(parent.ns), dict(parent.typelibs), parent.default, root)
+        for n in root.value:
+            if isinstance(n, str):
+                continue
+            if n.type not in DECLS:
+                continue
+            elif n.type == DATATYPES:
+                scope.typelibs[n.name] = n.value[0]
+                if top or n.name not in self.typelibs:
+                    self.typelibs[n.name] = n.value[0]
+                continue
+            elif n.type == DEFAULT_NS:
+                scope.default = n.value[0]
+                if top:
+                    self.default = n.value[0]
+                if n.name is None:
+                    continue
+
+            declared = self.ns.setdefault(n.name, n.value[0])
+            if declared != n.value[0]:
+                msg = "namespace prefix '%s' declared as both '%s' and '%s'"
+                location = scope.locate('decl', n.name)
+                raise ResolveError(msg % (n.name, declared, n.value[0]), location)
+            scope.ns[n.name] = n.value[0]
+        return scope
+
+    def qname(self, uri, local, prefix):
+        key = uri, local, prefix
+        if key not in self.qnames:
+            self.qnames[key] = QName(*(s if s is None else sys.intern(s) for s in key))
+        return self.qnames[key]
+
+    def name(self, name, ctx, scope):
+        key = name, ctx
+        if key in scope.names:
+            return scope.names[key]
+
+        prefix, sep, local = name.partition(':')
+        if not sep:
+            if name == '*':
+                uri = None
+            elif ctx == ELEM:
+                uri = scope.default if scope.default is not None else ''
+            else:
+                uri = ''
+            q = self.qname(uri, name, None)
+        elif prefix in scope.ns:
+            q = self.qname(scope.ns[prefix], local, prefix)
+        elif prefix in NAMESPACES:
+            (self.annotated if ctx == ANNOTATION else self.builtins).add(prefix)
+            q = self.qname(NAMESPACES[prefix], local, prefix)
+        else:
+            msg = "undeclared namespace prefix '%s' in name '%s'" % (prefix, name)
+            raise ResolveError(msg, scope.locate('ns', prefix))
+        scope.names[key] = q
+        return q
+
+    def datatype(self, name, scope):
+        key = name, DATATAG
+        if key in scope.names:
+            return scope.names[key]
+
+        prefix, sep, local = name.partition(':')
+        if not sep:
+            if name not in BUILTIN_TYPES:
+                msg = "unknown datatype '%s' (only string and token are built in)"
+                raise ResolveError(msg % name)
+            q = self.qname('', name, None)
+        elif prefix in scope.typelibs:
+            q = self.qname(scope.typelibs[prefix], local, prefix)
+        elif prefix in TYPELIBS:
+            self.typelibs.setdefault(prefix, TYPELIBS[prefix])
+            q = self.qname(TYPELIBS[prefix], local, prefix)
+        else:
+            msg = "undeclared datatypes prefix '%s' in datatype '%s'" % (prefix, name)
+            raise ResolveError(msg, scope.locate('datatypes', prefix))
+        scope.names[key] = q
+        return q
+
+def resolve(root, annotations=True):
+    return Resolver(annotations).resolve(root)
@@ -0,0 +1,104 @@
+# Parallel parsing of included files on a process pool. The include graph
+# is scanned up front (with just the lexer); every file is then parsed in a
+# worker with its includes replaced by placeholders, and the resulting
+# trees are spliced together in the parent process.
+from . import binary, parser
+from .parser import Node
+
+import concurrent.futures
+
+def scan(fn, fetch=parser.read):
+    '''Find all files (transitively) included by `fn`. Returns a dict that
+    maps the resolved name of each file (including `fn` itself) to a tuple
+    of the name to read it from and the resolved names of its includes.'''
+    files, todo = {}, [fn]
+    while todo:
+        fn = todo.pop()
+        key = parser.resolve(fn)
+        if key in files:
+            continue
+        path = parser.base_path(fn)
+        hrefs = parser.include_hrefs(parser.decode(fetch(fn)))
+        targets = [parser.include_target(path, href) for href in hrefs]
+        files[key] = fn, [parser.resolve(t) for t in targets]
+        todo.extend(targets)
+    return files
+
+def cyclic(files):
+    state = {}
+    for start in files:
+        stack = [(start, iter(files[start][1]))]
+        state[start] = 'active'
+        while stack:
+            key, children = stack[-1]
+            for child in children:
+                if state.get(child) == 'active':
+                    return True
+                elif child not in state and child in files:
+                    state[child] = 'active'
+                    stack.append((child, iter(files[child][1])))
+                    break
+            else:
+                state[key] = 'done'
+                stack.pop()
+    return False
+
+def parse_file(fn, children):
+    # Runs in a worker process; each include is parsed as a ROOT node that
+    # only holds the resolved name of the included file, a plain string.
+    # Errors are not passed back (ParseError cannot be pickled); the parent
+    # process reparses serially to report them instead.
+    includes = parser.Includes()
+    for key in children:
+        includes.trees[key] = Node('ROOT', None, [key])
+    try:
+        return binary.dumps(parser.parse(f=fn, includes=includes))
+    except Exception:
+        return None
+
+def splice(key, trees, done):
+    '''Replace the placeholders in the tree for `key` with the trees of the
+    files they stand for, (recursively) splicing those first.'''
+    if key in done:
+        return done[key]
+    root = trees[key]
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        children = [n for n in node.value if isinstance(n, Node)]
+        if node.type == 'ROOT' and len(children) < len(node.value):
+            value = []
+            for n in node.value:
+                if isinstance(n, str):
+                    value.extend(splice(n, trees, done).value)
+                else:
+                    value.append(n)
+            node.value = value
+        stack.extend(children)
+    done[key] = root
+    return root
+
+def load(fn, workers=None):
+    '''Parse the schema in file `fn`, parsing included files in parallel on
+    a pool of `workers` processes (default: one per CPU). The resulting tree
+    serializes to the same output as `parser.parse(f=fn)`. If includes form
+    a cycle or any file fails to parse, this falls back to a serial parse,
+    so that errors are reported the same way.'''
+    try:
+        files = scan(fn)
+    except (IOError, OSError, ValueError):
+        files = None
+    if files is None or cyclic(files):
+        return parser.parse(f=fn)
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        futures = [
+            (key, pool.submit(parse_file, name, children))
+            for (key, (name, children)) in files.items()
+        ]
+        results = [(key, future.result()) for (key, future) in futures]
+    if any(data is None for (key, data) in results):
+        return parser.parse(f=fn)
+
+    trees = dict((key, binary.loads(data)) for (key, data) in results)
+    return splice(parser.resolve(fn), trees, {})
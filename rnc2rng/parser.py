@@ -1,8 +1,9 @@
 from codecs import BOM_UTF16_BE, BOM_UTF16_LE
-from urllib.request import urlopen
 from urllib.parse import urljoin, urlparse
+from rply.grammar import Grammar
+from rply.parsergenerator import LRTable
 
-import rply, sys, os
+import rply, sys, os, json, re, hashlib
 
 KEYWORDS = set([
     'attribute', 'datatypes', 'default', 'div', 'element', 'empty', 'external',
@@ -10,53 +11,81 @@ KEYWORDS = set([
     'notAllowed', 'parent', 'start', 'string', 'text', 'token',
 ])
 
+KEYWORD_TOKENS = dict((kw, kw.upper()) for kw in KEYWORDS)
+
 NCNAME = r'[A-Za-z_][\w.-]*'
 
+# Alternatives are tried in order and the first one that matches wins, so
+# that e.g. COMBINE is preferred over PIPE and CNAME over ID.
+RULES = [
+    ('WS', r'\s+'),
+    ('LPAREN', r'\('),
+    ('RPAREN', r'\)'),
+    ('LBRACE', r'{'),
+    ('RBRACE', r'}'),
+    ('LBRACKET', r'\['),
+    ('RBRACKET', r'\]'),
+    ('COMBINE', r'\|=|&='),
+    ('EQUAL', r'='),
+    ('PIPE', r'[|]'),
+    ('COMMA', r','),
+    ('AMP', r'&'),
+    ('MINUS', r'[-]'),
+    ('STAR', r'[*]'),
+    ('PLUS', r'[+]'),
+    ('QMARK', r'[?]'),
+    ('CNAME', r'%s:(?:%s|\*)' % (NCNAME, NCNAME)),
+    ('QID', r'\\%s' % NCNAME),
+    ('ID', NCNAME),
+    ('LITERAL', r'".*?"'),
+    ('DOCUMENTATION', r'##.*'),
+    ('COMMENT', r'#.*'),
+    ('TILDE', r'~'),
+    ('ERROR', r'[\s\S]'),
+]
+
 def lexer():
-    lg = rply.LexerGenerator()
-    lg.add('LPAREN', r'\(')
-    lg.add('RPAREN', r'\)')
-    lg.add('LBRACE', r'{')
-    lg.add('RBRACE', r'}')
-    lg.add('LBRACKET', r'\[')
-    lg.add('RBRACKET', r'\]')
-    lg.add('COMBINE', r'\|=|&=')
-    lg.add('EQUAL', r'=')
-    lg.add('PIPE', r'[|]')
-    lg.add('COMMA', r',')
-    lg.add('AMP', r'&')
-    lg.add('MINUS', r'[-]')
-    lg.add('STAR', r'[*]')
-    lg.add('PLUS', r'[+]')
-    lg.add('QMARK', r'[?]')
-    lg.add('CNAME', r'%s:(%s|\*)' % (NCNAME, NCNAME))
-    lg.add('QID', r'\\%s' % NCNAME)
-    lg.add('ID', NCNAME)
-    lg.add('LITERAL', r'".*?"')
-    lg.add('DOCUMENTATION', r'##.*')
-    lg.add('COMMENT', r'#.*')
-    lg.add('TILDE', r'~')
-    lg.ignore(r'\s+')
-    return lg.build()
+    return re.compile('|'.join('(?P<%s>%s)' % rule for rule in RULES))
 
 LEXER = lexer()
 
+def position(src, idx):
+    lineno = src.count('\n', 0, idx) + 1
+    return rply.token.SourcePosition(idx, lineno, idx - src.rfind('\n', 0, idx))
+
+class Token(rply.Token):
+    '''An rply Token that computes its source position on demand, since
+    line and column numbers are only needed for error reporting.'''
+    def __init__(self, name, value, src, idx):
+        self.name = name
+        self.value = value
+        self.src = src
+        self.idx = idx
+    @property
+    def source_pos(self):
+        return position(self.src, self.idx)
+
 def lex(src):
-    for t in LEXER.lex(src):
-        if t.name == 'ID' and t.value in KEYWORDS:
-            t.name = t.value.upper()
-        elif t.name == 'LITERAL':
-            t.value = t.value[1:-1]
-        elif t.name == 'COMMENT':
+    for m in LEXER.finditer(src):
+        name = m.lastgroup
+        if name == 'WS' or name == 'COMMENT':
             continue
-        yield t
+        elif name == 'ID':
+            value = m.group()
+            yield Token(KEYWORD_TOKENS.get(value, name), value, src, m.start())
+        elif name == 'LITERAL':
+            yield Token(name, m.group()[1:-1], src, m.start())
+        elif name == 'ERROR':
+            raise rply.LexingError(None, position(src, m.start()))
+        else:
+            yield Token(name, m.group(), src, m.start())
 
 pg = rply.ParserGenerator([
     'AMP', 'CNAME', 'COMBINE', 'COMMA', 'DOCUMENTATION', 'EQUAL', 'ID',
     'LBRACE', 'LBRACKET', 'LPAREN', 'LIST', 'LITERAL', 'MINUS', 'MIXED',
     'PLUS', 'PIPE', 'QID', 'QMARK', 'RBRACE', 'RBRACKET', 'RPAREN', 'STAR',
     'TILDE',
-] + [s.upper() for s in KEYWORDS], precedence=[("left", ['TILDE'])])
+] + [s.upper() for s in KEYWORDS])
 
 
 class Node(object):
@@ -67,10 +96,35 @@ class Node(object):
         self.value = value or []
         assert isinstance(self.value, list), self.value
     def __repr__(self):
-        bits = [(k, getattr(self, k, None)) for k in self.__slots__]
+        bits = [(k, getattr(self, k, None)) for k in Node.__slots__]
         strs = ['%s=%r' % (k, v) for (k, v) in bits if v is not None]
         return 'Node(%s)' % ', '.join(strs)
 
+class Root(Node):
+    '''The root of a parsed document. `prefixes` maps ('ns', prefix),
+    ('datatypes', prefix) and ('decl', prefix) to the offset in `source`
+    (the source of the document from file `fn`) of the first name using
+    that namespace prefix, datatype using that datatypes prefix, or
+    declaration of that namespace prefix in the document, to report errors
+    found after parsing (see `locate()`).'''
+
+    __slots__ = 'prefixes', 'fn', 'source', '__weakref__'
+
+    def __init__(self, type, name, value=None, prefixes=None, fn=None, source=None):
+        Node.__init__(self, type, name, value)
+        self.prefixes = prefixes if prefixes is not None else {}
+        self.fn = fn
+        self.source = source
+
+    def locate(self, key):
+        '''Get the location (file name, line, column and source line) for
+        `key` in `prefixes`, or None if it is not there.'''
+        if key not in self.prefixes:
+            return None
+        idx = self.prefixes[key]
+        t = Token('PREFIX', self.source[idx], self.source, idx)
+        return (self.fn,) + State(self.fn, self.source).locate(t)
+
 def pprint(n, level=0):
     if isinstance(n, list):
         print('[')
@@ -99,21 +153,29 @@ for _node_type in NODE_TYPES:
 
 @pg.production('start : preamble top-level-body')
 def start(s, p):
-    return Node('ROOT', None, p[0] + p[1])
+    # the source is only kept for locating prefixes, if there are any
+    source = s.src if s.prefixes else None
+    return Root('ROOT', None, p[0] + p[1], s.prefixes, s.fn, source)
 
-@pg.production('strlit : LITERAL')
+@pg.production('strlit : literals')
 def strlit_literal(s, p): # from datatypeValue
-    return p[0]
+    if len(p[0]) > 1:
+        p[0][0].value = ''.join(t.value for t in p[0])
+    return p[0][0]
 
-@pg.production('strlit : strlit TILDE strlit')
+@pg.production('literals : LITERAL')
+def literals_single(s, p):
+    return [p[0]]
+
+@pg.production('literals : literals TILDE LITERAL')
 def strlit_concat(s, p):
-    p[0].value += p[2].value
+    p[0].append(p[2])
     return p[0]
 
-@pg.production('preamble : decl preamble')
+@pg.production('preamble : preamble decl')
 def preamble_multi(s, p):
-    p[1].insert(0, p[0])
-    return p[1]
+    p[0].append(p[1])
+    return p[0]
 
 @pg.production('preamble : ')
 def preamble_empty(s, p):
@@ -125,10 +187,12 @@ def decl_default_ns(s, p):
 
 @pg.production('decl : DEFAULT NAMESPACE id-or-kw EQUAL ns-uri-lit')
 def decl_default_names_ns(s, p):
+    s.use('decl', p[1], p[2].name)
     return Node('DEFAULT_NS', p[2].name, p[4])
 
 @pg.production('decl : NAMESPACE id-or-kw EQUAL ns-uri-lit')
 def decl_ns(s, p):
+    s.use('decl', p[0], p[1].name)
     return Node('NS', p[1].name, p[3])
 
 @pg.production('ns-uri-lit : strlit')
@@ -165,15 +229,23 @@ def top_level_element(s, p):
 def top_level_grammar(s, p):
     return p[0]
 
-@pg.production('grammar-content : member grammar-content')
-def grammar_multi(s, p):
-    p[1].insert(0, p[0])
-    return p[1]
+@pg.production('grammar-content : members')
+def grammar_members(s, p):
+    return p[0]
 
 @pg.production('grammar-content : ')
 def grammar_empty(s, p):
     return []
 
+@pg.production('members : members member')
+def grammar_multi(s, p):
+    p[0].append(p[1])
+    return p[0]
+
+@pg.production('members : member')
+def grammar_single(s, p):
+    return [p[0]]
+
 @pg.production('member : annotations component')
 def member_annotated_component(s, p):
     p[1].value = p[0] + p[1].value
@@ -181,6 +253,7 @@ def member_annotated_component(s, p):
 
 @pg.production('member : CNAME annotation-attributes-content')
 def member_foreign_element_annotation(s, p):
+    s.use('ns', p[0])
     return Node('ANNOTATION', p[0].value, p[1])
 
 @pg.production('component : define')
@@ -213,11 +286,20 @@ def component_div(s, p):
 
 @pg.production('component : INCLUDE strlit opt-inherit opt-include-content')
 def component_include(s, p):
-    if is_url(s.path) or is_url(p[1].value):  # it's a URL
-        url = urljoin(s.path, p[1].value)
-    else:
-        url = os.path.join(s.path, p[1].value)
-    return parse(f=url)
+    url = include_target(s.path, p[1].value)
+    key = resolve(url)
+    if s.includes.chain:
+        s.includes.edges[s.includes.chain[-1]].append(key)
+    if key in s.includes.chain:
+        chain = s.includes.chain[s.includes.chain.index(key):] + [key]
+        raise IncludeCycleError(chain, p[0], s.fn, *s.locate(p[0]))
+    root = s.includes.trees.get(key)
+    if root is None:
+        root = s.includes.trees[key] = parse(f=url, includes=s.includes)
+    # Callers may replace the value list (e.g. to prepend annotations)
+    if not isinstance(root, Root): # e.g. from a cache
+        return Node('ROOT', None, list(root.value))
+    return Root('ROOT', None, list(root.value), root.prefixes, root.fn, root.source)
 
 @pg.production('opt-inherit : INHERIT EQUAL id-or-kw')
 def opt_inherit(s, p):
@@ -235,10 +317,10 @@ def opt_include_content(s, p):
 def opt_include_content_none(s, p):
     return []
 
-@pg.production('include-body : include-member include-body')
+@pg.production('include-body : include-body include-member')
 def include_content_multi(s, p):
-    p[1].insert(0, p[0])
-    return p[1]
+    p[0].append(p[1])
+    return p[0]
 
 @pg.production('include-body : ')
 def include_content_empty(s, p):
@@ -276,6 +358,7 @@ def annotations_empty(s, p):
 
 @pg.production('start-annotation-content : CNAME cname-annotation-content')
 def start_annotation_content_cname(s, p):
+    s.use('ns', p[0])
     p[1][0].name = p[0].value
     return p[1]
 
@@ -301,6 +384,7 @@ def cname_annotation_content_element(s, p):
 
 @pg.production('start-annotations : CNAME cname-annotations')
 def start_annotations_cname(s, p):
+    s.use('ns', p[0])
     p[1][0].name = p[0].value
     return p[1]
 
@@ -328,10 +412,10 @@ def annotation_content_literal(s, p):
 def annotation_content_empty(s, p):
     return []
 
-@pg.production('annotation-elements : annotation-element annotation-elements')
+@pg.production('annotation-elements : annotation-elements annotation-element')
 def annotation_elements_multi(s, p):
-    p[1].insert(0, p[0])
-    return p[1]
+    p[0].append(p[1])
+    return p[0]
 
 @pg.production('annotation-elements : ')
 def annotation_elements_empty(s, p):
@@ -339,6 +423,7 @@ def annotation_elements_empty(s, p):
 
 @pg.production('annotation-element : CNAME annotation-attributes-content')
 def nested_annotation_element(s, p):
+    s.use('ns', p[0])
     return Node('ANNOTATION', p[0].value, p[1])
 
 @pg.production('pattern : particle')
@@ -349,10 +434,10 @@ def pattern_particle(s, p):
 def pattern_choice(s, p):
     return [p[0]]
 
-@pg.production('particle-choice : particle PIPE particle-choice')
+@pg.production('particle-choice : particle-choice PIPE particle')
 def particle_choice_multi(s, p):
-    p[2].value.insert(0, p[0])
-    return p[2]
+    p[0].value.append(p[2])
+    return p[0]
 
 @pg.production('particle-choice : particle PIPE particle')
 def particle_choice_single(s, p):
@@ -362,10 +447,10 @@ def particle_choice_single(s, p):
 def pattern_seq(s, p):
     return [p[0]]
 
-@pg.production('particle-group : particle COMMA particle-group')
+@pg.production('particle-group : particle-group COMMA particle')
 def particle_group_multi(s, p):
-    p[2].value.insert(0, p[0])
-    return p[2]
+    p[0].value.append(p[2])
+    return p[0]
 
 @pg.production('particle-group : particle COMMA particle')
 def particle_group_single(s, p):
@@ -375,10 +460,10 @@ def particle_group_single(s, p):
 def pattern_interleave(s, p):
     return [p[0]]
 
-@pg.production('particle-interleave : particle AMP particle-interleave')
+@pg.production('particle-interleave : particle-interleave AMP particle')
 def particle_interleave_multi(s, p):
-    p[2].value.insert(0, p[0])
-    return p[2]
+    p[0].value.append(p[2])
+    return p[0]
 
 @pg.production('particle-interleave : particle AMP particle')
 def particle_interleave_single(s, p):
@@ -435,14 +520,17 @@ def primary_literal(s, p): # from datatypeValue
 
 @pg.production('primary : CNAME')
 def primary_cname(s, p):
+    s.use('datatypes', p[0])
     return Node('DATATAG', p[0].value)
 
 @pg.production('primary : CNAME strlit')
 def primary_ctyped_string(s, p):
+    s.use('datatypes', p[0])
     return Node('LITERAL', p[1].value, [Node('LITERAL_TYPE', p[0].value)])
 
 @pg.production('primary : CNAME LBRACE params RBRACE')
 def primary_type_params(s, p):
+    s.use('datatypes', p[0])
     return Node('DATATAG', p[0].value, p[2])
 
 @pg.production('primary : STRING')
@@ -528,10 +616,10 @@ def except_name_class_simple(s, p):
     p[0][0].value = [Node('EXCEPT', None, p[2])]
     return p[0]
 
-@pg.production('name-class-choice : simple-name-class PIPE name-class-choice')
+@pg.production('name-class-choice : name-class-choice PIPE simple-name-class')
 def name_class_choice_nested(s, p):
-    p[2][0].value.insert(0, p[0][0])
-    return p[2]
+    p[0][0].value.append(p[2][0])
+    return p[0]
 
 @pg.production('name-class-choice : simple-name-class PIPE simple-name-class')
 def name_class_choice_simple(s, p):
@@ -549,13 +637,13 @@ def simple_name_class_name(s, p):
 def name_class_group(s, p):
     return p[1]
 
-@pg.production('documentations : DOCUMENTATION documentations')
+@pg.production('documentations : documentations DOCUMENTATION')
 def documentations_multi(s, p):
-    cur = Node('DOCUMENTATION', None, []) if not p[1] else p[1][0]
-    content = p[0].value.lstrip('#').rstrip('\r') # strip all leading "#" ( left-recursion in documentationLineContent)
+    cur = Node('DOCUMENTATION', None, []) if not p[0] else p[0][0]
+    content = p[1].value.lstrip('#').rstrip('\r') # strip all leading "#" ( left-recursion in documentationLineContent)
     if content.startswith(' '):
         content = content[1:] # strip *one* " ", but no more (now the production is readOfLine)
-    cur.value.insert(0, content)
+    cur.value.append(content)
     return [cur]
 
 @pg.production('documentations : ')
@@ -564,6 +652,7 @@ def documentations_empty(s, p):
 
 @pg.production('name : CNAME')
 def name_cname(s, p):
+    s.use('ns', p[0])
     return Node('NAME', p[0].value)
 
 @pg.production('name : id-or-kw')
@@ -677,24 +766,124 @@ class ParseError(Exception):
         self.msg = '\n'.join((loc, line, ' ' * spaces + '^'))
         Exception.__init__(self, self.msg)
 
+class IncludeCycleError(ParseError):
+
+    def __init__(self, chain, t, fn, ln, col, line):
+        ParseError.__init__(self, t, fn, ln, col, line)
+        self.chain = chain
+        self.msg = 'include cycle: %s\n%s' % (' -> '.join(chain), self.msg)
+        self.args = self.msg,
+
 @pg.error
 def error(s, t):
-    ln = t.source_pos.lineno - 1
-    if t.value and t.value[0] == '\n':
-        ln -= 1
-    col = t.source_pos.colno - 1
-    line = s.lines[ln] if ln < len(s.lines) else ''
-    raise ParseError(t, s.fn, ln, col, line)
-
-parser = pg.build()
+    raise ParseError(t, s.fn, *s.locate(t))
+
+TABLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parsetab.json')
+
+def build_grammar():
+    g = Grammar(pg.tokens)
+    for level, (assoc, terms) in enumerate(pg.precedence, 1):
+        for term in terms:
+            g.set_precedence(term, assoc, level)
+    for name, syms, func, precedence in pg.productions:
+        g.add_production(name, syms, func, precedence)
+    g.set_start()
+    return g
+
+def tables(g):
+    g.build_lritems()
+    g.compute_first()
+    g.compute_follow()
+    return LRTable.from_grammar(g)
+
+def build(fn=TABLES):
+    '''Build the LALR parser from the precompiled tables in `fn`. The tables
+    are only used if they were generated by the same rply table format for
+    the current grammar; otherwise, they are rebuilt from scratch.'''
+    g = build_grammar()
+    try:
+        with open(fn) as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        data = {}
+    valid = data.get('version') == pg.VERSION and data.get('hash') == pg.compute_grammar_hash(g)
+    valid = valid and pg.data_is_valid(g, data)
+    table = LRTable.from_cache(g, data) if valid else tables(g)
+    return rply.parser.LRParser(table, pg.error_handler)
+
+def write_tables(fn=TABLES):
+    '''Regenerate the precompiled parser tables. Run this after changing the
+    grammar, so that importing the parser does not need to rebuild them.'''
+    g = build_grammar()
+    data = pg.serialize_table(tables(g))
+    data['version'] = pg.VERSION
+    data['hash'] = pg.compute_grammar_hash(g)
+    with open(fn, 'w') as f:
+        json.dump(data, f, sort_keys=True, separators=(',', ':'))
+
+# The compiled parser holds no state of its own while parsing (that is kept
+# in a State and an Includes registry per call), so concurrent parses in
+# different threads can share it.
+parser = build()
+
+LINE_BREAK = re.compile('\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+
+class Includes(object):
+    '''Registry of the files included during a single conversion, so that
+    every file is only parsed once. `trees` maps the resolved path or URL
+    to the parsed tree; `chain` holds the files currently being parsed,
+    `edges` the files directly included by each file parsed and `digests`
+    the content hash of every file read. Files are read through `fetch`, a
+    function that takes a path or URL and returns its bytes.'''
+    def __init__(self, fetch=None):
+        self.trees = {}
+        self.chain = []
+        self.edges = {}
+        self.digests = {}
+        self.fetch = fetch if fetch is not None else read
 
 class State(object):
-    def __init__(self, fn, src):
+    def __init__(self, fn, src, includes=None):
         self.fn = fn
-        self.path = os.getcwd()
-        if fn is not None:
-            self.path = os.path.dirname(os.path.abspath(fn)) if not is_url(fn) else fn
-        self.lines = src.splitlines()
+        self.path = base_path(fn)
+        self.src = src
+        self.starts = None
+        self.includes = includes if includes is not None else Includes()
+        self.prefixes = {}
+
+    def locate(self, t):
+        '''Get the (zero-based) line and column of token `t`, and the source
+        line it occurs on, for error reporting.'''
+        pos = t.source_pos
+        if pos is None: # rply's end of input token, point after the last token
+            pos = position(self.src, len(self.src.rstrip()))
+        ln = pos.lineno - 1
+        if t.value and t.value[0] == '\n':
+            ln -= 1
+        return ln, pos.colno - 1, self.line(ln)
+
+    def use(self, kind, t, prefix=None):
+        '''Record the offset of token `t` as the first use of a prefix of
+        `kind` (see `Root`), if it is. The prefix is taken from `t` if not
+        given.'''
+        if prefix is None:
+            prefix = t.value.partition(':')[0]
+        self.prefixes.setdefault((kind, prefix), t.idx)
+
+    def line(self, ln):
+        '''Get the source line at (zero-based) index `ln`, split the same
+        way as str.splitlines() does. Line offsets are only computed when
+        first needed, since this is only used for error reporting.'''
+        if self.starts is None:
+            starts = [0] + [m.end() for m in LINE_BREAK.finditer(self.src)]
+            if starts[-1] == len(self.src):
+                starts.pop()
+            self.starts = starts
+        if ln >= len(self.starts):
+            return ''
+        start = self.starts[ln]
+        m = LINE_BREAK.search(self.src, start)
+        return self.src[start:m.start() if m else len(self.src)]
 
 if sys.version_info[0] < 3:
     str_types = str, bytes, unicode  # noqa: unicode not defined in Python 3
@@ -705,21 +894,91 @@ def is_url(fn):
     parse_result = urlparse(fn)
     return parse_result.scheme in ('http', 'https', 'file')
 
-def parse(src=None, f=None):
+def resolve(fn):
+    return fn if is_url(fn) else os.path.realpath(fn)
+
+def base_path(fn):
+    if fn is None:
+        return os.getcwd()
+    return os.path.dirname(os.path.abspath(fn)) if not is_url(fn) else fn
+
+def include_target(path, href):
+    '''Get the path or URL of the file included as `href` from a file in
+    `path` (see `base_path()`).'''
+    if is_url(path) or is_url(href):  # it's a URL
+        return urljoin(path, href)
+    else:
+        return os.path.join(path, href)
+
+def read(fn):
+    if is_url(fn):
+        from urllib.request import urlopen
+        with urlopen(fn) as f:
+            return f.read()
+    else:
+        with open(fn, 'rb') as f:
+            return f.read()
+
+def digest(bytes):
+    return hashlib.sha256(bytes).hexdigest()
+
+def decode(bytes):
+    bom = bytes[:2] in {BOM_UTF16_BE, BOM_UTF16_LE}
+    return bytes.decode('utf-16' if bom else 'utf-8')
+
+def include_hrefs(src):
+    '''Find the targets of the include directives in `src` with only the
+    lexer, e.g. to fetch included files ahead of parsing. Lexing errors are
+    ignored here; they will be reported when parsing.'''
+    hrefs, parts, expect = [], None, None
+    try:
+        for t in lex(src):
+            if parts is not None:
+                if t.name == expect == 'LITERAL':
+                    parts.append(t.value)
+                    expect = 'TILDE'
+                    continue
+                elif t.name == expect == 'TILDE':
+                    expect = 'LITERAL'
+                    continue
+                elif expect == 'TILDE':
+                    hrefs.append(''.join(parts))
+                parts = None
+            if t.name == 'INCLUDE':
+                parts, expect = [], 'LITERAL'
+    except rply.LexingError:
+        pass
+    if parts and expect == 'TILDE':
+        hrefs.append(''.join(parts))
+    return hrefs
+
+def parse(src=None, f=None, includes=None):
+    '''Parse the schema in `src` (a string) or `f` (a file name, URL or file
+    object). Calls are reentrant and thread-safe, as long as concurrent
+    calls do not share the `includes` registry.'''
     assert src is None or f is None
+    includes = includes if includes is not None else Includes()
     if f is not None and isinstance(f, str_types):
         fn = f
-        if is_url(fn):
-            with urlopen(fn) as f:
-                bytes = f.read()
-        else:
-            with open(fn, 'rb') as f:
-                bytes = f.read()
-        bom = bytes[:2] in {BOM_UTF16_BE, BOM_UTF16_LE}
-        src = bytes.decode('utf-16' if bom else 'utf-8')
+        bytes = includes.fetch(fn)
+        includes.digests[resolve(fn)] = digest(bytes)
+        src = decode(bytes)
     elif f is not None:
         fn, src = f.name, f.read()
     else:
         # Caller only gave source code, no filename.
         fn = None
-    return parser.parse(lex(src), state=State(fn, src))
+
+    state = State(fn, src, includes)
+    if fn is not None:
+        includes.chain.append(resolve(fn))
+        includes.edges[resolve(fn)] = []
+    try:
+        return parser.parse(lex(src), state=state)
+    except rply.LexingError as e:
+        # characters that start no token, like a quote that is not closed
+        t = Token('ERROR', src[e.source_pos.idx], src, e.source_pos.idx)
+        raise ParseError(t, fn, *state.locate(t)) from None
+    finally:
+        if fn is not None:
+            includes.chain.pop()
@@ -14,4 +14,4 @@ def token_list(src):
     return parser.lex(src)
 
 def make_nodetree(tokens):
-    return Tree(parser.parser.parse(tokens, parser.State()))
+    return Tree(parser.parser.parse(tokens, parser.State(None, '')))
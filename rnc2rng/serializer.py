@@ -1,6 +1,6 @@
 # Convert an RELAX NG compact syntax schema to a Node tree
 # This file released to the Public Domain by David Mertz
-from . import parser
+from . import flat, names, parser, simplification
 from rnc2rng.parser import (
     ANNO_ATTR, ANNOTATION, ANY, ASSIGN, ATTR, CHOICE, DATATAG, DATATYPES,
     DEFAULT_NS, DEFINE, DIV, DOCUMENTATION, ELEM, EMPTY, EXCEPT, GRAMMAR,
@@ -8,49 +8,116 @@ from rnc2rng.parser import (
     PARAM, PARENT, REF, ROOT, SEQ, SOME, TEXT, LITERAL_TYPE
 )
 
-import html
+import collections, copy, html, itertools, re
 
 QUANTS = {SOME: 'oneOrMore', MAYBE: 'optional', ANY: 'zeroOrMore'}
-TYPELIBS = {
-    'xsd': 'http://www.w3.org/2001/XMLSchema-datatypes'
-}
-NAMESPACES = {
-    'a': 'http://relaxng.org/ns/compatibility/annotations/1.0',
-    'xml': 'http://www.w3.org/XML/1998/namespace',
-}
-
-class XMLSerializer(object):
-
-    def __init__(self, indent=None):
-        self.indent = indent or '  '
+TAGS = dict((t, t.lower()) for t in (
+    GRAMMAR, INTERLEAVE, CHOICE, MIXED, LIST, DIV, GROUP, REF, PARENT, TEXT, EMPTY
+))
+TAGS.update(QUANTS, NOT_ALLOWED='notAllowed')
+TYPELIBS, NAMESPACES = names.TYPELIBS, names.NAMESPACES
+
+RNG = 'http://relaxng.org/ns/structure/1.0'
+
+# Contexts for the names in an attribute's name class: they are in no
+# namespace unless prefixed (see `Visitor.qname()`).
+ATTR_EXCEPT = 'ATTR EXCEPT'
+ATTR_CTX = set([ATTR, ATTR_EXCEPT])
+
+# The nodes visited: Node objects, or views of the nodes of a flat tree.
+NODES = parser.Node, flat.View
+
+# Number of lines written at a time by `XMLSerializer.dump()`, and the
+# number of events generated at a time by `Visitor.chunks()`.
+CHUNK_LINES = 1024
+CHUNK_EVENTS = 1024
+
+SPECIAL = re.compile('[&<>"\']')
+
+def escape(s):
+    # html.escape(), skipping the common case of nothing to escape
+    return html.escape(s) if SPECIAL.search(s) else s
+
+class Visitor(object):
+    '''Generates a stream of events describing the RELAX NG XML document for
+    a tree, as tuples of one of these forms:
+
+    - ('start', tag, attrs): start of an element, where `attrs` is a list
+      of (name, value) pairs, in document order
+    - ('text', text): character data
+    - ('end', tag): end of an element
+
+    Names are written as in the XML output, with namespace prefixes; the
+    namespaces used are declared (through `xmlns:*` attributes) on the
+    grammar element. Attribute values and text are not escaped. The
+    `compact`, `annotations` and `simplify` options are those of
+    `XMLSerializer`.
+
+    Names are resolved (see the `names` module) in a pass over the tree
+    before the first event, and looked up again while visiting it, without
+    copying the tree. Trees resolved beforehand are visited as they are.
+    Flat trees (see the `flat` module) are visited through views of their
+    nodes, without building Node objects.'''
+
+    def __init__(self, compact=False, annotations=True, simplify=False):
+        self.compact = compact
+        self.annotations = annotations
+        self.simplify = simplify
+        self.handlers = self.HANDLERS if annotations else self.PLAIN_HANDLERS
+        self.skipped = set(t for (t, h) in self.handlers.items() if h is Visitor.skip)
         self.reset()
 
     def reset(self):
-        self.buf = []
         self.ns = {}
         self.typelibs = {}
+        self.library = TYPELIBS['xsd']
         self.default = ''
-        self.level = 0
-
-    def write(self, s):
-        self.buf.append(self.indent * self.level + s)
-
-    def datatype_library(self, prefix):
-        assert prefix in self.typelibs or prefix in TYPELIBS, prefix
-        if prefix not in self.typelibs:
-            self.typelibs[prefix] = TYPELIBS[prefix]
-        return self.typelibs[prefix]
-
-    def namespace(self, ns):
-        assert ns in self.ns or ns in NAMESPACES, ns
-        if ns not in self.ns:
-            self.ns[ns] = NAMESPACES[ns]
-        return self.ns[ns]
-
-    def toxml(self, node):
-
+        self.queue = []
+        self.resolver = self.scope = None
+
+    def events(self, node):
+        '''Generate the events for the tree `node`. Each call works on its
+        own copy of the visitor, so one instance can be shared between
+        threads.'''
+        return itertools.chain.from_iterable(self.chunks(node))
+
+    def chunks(self, node):
+        '''Like `events()`, but generates lists of events (of about
+        `CHUNK_EVENTS` each), which is faster to consume.'''
+        return copy.copy(self).generate(node)
+
+    def generate(self, node):
+        # The declarations for the grammar element, for all namespaces and
+        # datatype libraries used, are only known after resolving all names
+        # (a resolved tree starts with them).
         self.reset()
-        for n in node.value:
+        if self.simplify:
+            node = simplification.Simplifier().simplify(node)
+        if isinstance(node, names.Resolved):
+            decls = node.value
+            if not self.annotations:
+                decls = [n for n in decls if n.type != NS or n.name not in node.anno_prefixes]
+            self.declare(decls)
+            libraries = self.scan(node.value) if self.compact else None
+        else:
+            self.resolver = names.Resolver(self.annotations)
+            self.scope = self.resolver.scan(node)
+            self.declare(self.resolver.declarations())
+            libraries = self.resolver.libraries
+            if isinstance(node, flat.FlatTree):
+                node = node.root
+        if self.compact:
+            used = libraries.most_common(1)
+            self.library = used[0][0] if used else ''
+
+        self.start('grammar', self.grammar_attrs())
+        for chunk in self.visit(node.value):
+            yield chunk
+        self.end('grammar')
+        yield self.queue
+
+    def declare(self, nodes):
+        for n in nodes:
             if n.type == DATATYPES:
                 self.typelibs[n.name] = n.value[0]
             elif n.type == DEFAULT_NS:
@@ -60,231 +127,383 @@ class XMLSerializer(object):
             elif n.type == NS:
                 self.ns[n.name] = n.value[0]
 
-        prelude = ['<?xml version="1.0" encoding="UTF-8"?>']
-        prelude.append('<grammar xmlns="http://relaxng.org/ns/structure/1.0"')
+    def grammar_attrs(self):
+        attrs = [('xmlns', RNG)]
         if self.default and self.default != 'inherit':
-            prelude.append('         ns="%s"' % self.default)
+            attrs.append(('ns', self.default))
 
-        self.visit(node.value)
         for ns, url in sorted(self.ns.items()):
             if url and url != 'inherit':
-                prelude.append('         xmlns:%s="%s"' % (ns, url))
+                attrs.append(('xmlns:%s' % ns, url))
 
         # if xsd:* ever referenced, print it at the grammar level
-        if 'xsd' in self.typelibs:
-            prelude.append('         datatypeLibrary="%s"' % self.typelibs['xsd'])
+        if self.compact and self.library:
+            attrs.append(('datatypeLibrary', self.library))
+        elif not self.compact and 'xsd' in self.typelibs:
+            attrs.append(('datatypeLibrary', self.typelibs['xsd']))
+        return attrs
 
-        prelude[-1] = prelude[-1] + '>'
-        self.write('</grammar>')
-        return '\n'.join(prelude + self.buf)
+    def scan(self, nodes):
+        '''Count the datatype libraries used in the resolved `nodes`, as a
+        Counter.'''
+        libraries = collections.Counter()
+        skipped = self.skipped
+        Node = parser.Node
+        stack = list(reversed(nodes))
+        while stack:
+            x = stack.pop()
+            if x.type == DATATAG or x.type == LITERAL_TYPE:
+                libraries[x.name.uri] += 1
+            if x.value and x.type not in skipped:
+                stack.extend(n for n in reversed(x.value) if isinstance(n, Node))
+        return libraries
+
+    def qname(self, name, ctx):
+        # the resolved name for a name in context `ctx`, unless the tree
+        # was resolved beforehand
+        if self.resolver is None:
+            return name
+        elif ctx != ANNOTATION:
+            ctx = ATTR if ctx in ATTR_CTX else ELEM
+        return self.resolver.name(name, ctx, self.scope)
+
+    def datatype(self, name):
+        if self.resolver is None:
+            return name
+        return self.resolver.datatype(name, self.scope)
 
     def anno_attrs(self, nodes):
-        select = lambda n: isinstance(n, parser.Node) and n.type == ANNO_ATTR
-        pairs = [(n.name, html.escape(n.value[0])) for n in nodes if select(n)]
-        if not pairs:
-            return ''
-        return ' ' + ' '.join('%s="%s"' % attr for attr in pairs)
+        if not self.annotations:
+            return []
+        return [
+            (str(self.qname(n.name, ANNOTATION)), n.value[0]) for n in nodes
+            if isinstance(n, NODES) and n.type == ANNO_ATTR
+        ]
 
     def type_attrs(self, name):
-        if ':' in name:
-            prefix, name = name.split(':', 1)
-            ns = self.datatype_library(prefix)
-        else:
-            assert name in ('string', 'token') # these are the only "built-in" datatypes
-            ns = ""
-
-        attrs = ' type="%s"' % name
-        if ns != TYPELIBS['xsd']:
-            attrs += ' datatypeLibrary="%s"' % ns # write all exceptions explicitly
+        name = self.datatype(name)
+        attrs = [('type', name.local)]
+        if name.uri != self.library:
+            attrs.append(('datatypeLibrary', name.uri)) # write all exceptions explicitly
         return attrs
 
-    def visit(self, nodes, ctx=None, indent=True):
-        '''Visiting a list of nodes, writes out the XML content to the internal
-        line-based buffer. By default, adds one level of indentation to the
-        output compared to the caller's level; passing False as the second
-        argument will prevent this from happening.'''
-        if indent:
-            self.level += 1
-        for x in nodes:
-
-            if not isinstance(x, parser.Node):
+    def start(self, tag, attrs=()):
+        self.queue.append(('start', tag, list(attrs)))
+
+    def end(self, tag):
+        self.queue.append(('end', tag))
+
+    def leaf(self, tag, attrs=(), text=None):
+        self.queue.append(('start', tag, list(attrs)))
+        if text is not None:
+            self.queue.append(('text', text))
+        self.queue.append(('end', tag))
+
+    def text(self, s):
+        self.queue.append(('text', s))
+
+    def visit(self, nodes, ctx=None):
+        '''Generate the events for a list of nodes, in chunks; events left
+        over at the end remain in `self.queue`.
+
+        Nodes are visited from an explicit stack rather than by recursion,
+        so the depth of the tree is not limited by the recursion limit. The
+        stack holds (node, ctx) pairs; the handler for each node's type
+        (from `HANDLERS`) queues the events for its start tag right away
+        and pushes its children and end tag (as an (end, tag) pair, where
+        `end` is the method to call).'''
+        stack = []
+        self.push(stack, nodes, ctx)
+        handlers = self.handlers
+        while stack:
+            x, ctx = stack.pop()
+            if isinstance(x, NODES):
+                handler = handlers.get(x.type)
+                assert handler is not None, x
+                handler(self, x, ctx, stack)
+            elif callable(x):
+                x(ctx)
+            else:
                 raise TypeError("Not a Node: " + repr(x))
-            elif x.type in set([ANNO_ATTR, LITERAL_TYPE, DATATYPES, DEFAULT_NS, NS]):
-                continue
-
-            attribs = self.anno_attrs(x.value)
-            if x.type == DEFINE:
-                for op in (x.name for x in x.value if x.type == 'ASSIGN'):
-                    modes = {'|=': 'choice', '&=': 'interleave'}
-                    if op in modes:
-                        attribs = (' combine="%s"' % modes[op]) + attribs
-                    break;
-
-                if x.name == 'start':
-                    self.write('<start%s>' % attribs)
-                else:
-                    bits = x.name, attribs
-                    self.write('<define name="%s"%s>' % bits)
-
-                self.visit(x.value)
-                if x.name == 'start':
-                    self.write('</start>')
-                else:
-                    self.write('</define>')
-
-            elif x.type == ASSIGN:
-                self.visit(x.value, indent=False)
-            elif x.type == GRAMMAR:
-                self.write('<grammar>')
-                self.visit(x.value)
-                self.write('</grammar>')
-            elif x.type in set([MAYBE, SOME, ANY]):
-                self.write('<%s>' % QUANTS[x.type])
-                self.visit(x.value)
-                self.write('</%s>' % QUANTS[x.type])
-            elif x.type in set([INTERLEAVE, CHOICE, MIXED, LIST, DIV]):
-                self.write('<%s>' % x.type.lower())
-                self.visit(x.value)
-                self.write('</%s>' % x.type.lower())
-            elif x.type == EXCEPT:
-                self.write('<except>')
-                self.visit(x.value, ctx=ctx)
-                self.write('</except>')
-            elif x.type == NAME:
-                if not x.value and '*' in x.name:
-                    if x.name == '*':
-                        self.write('<anyName/>')
-                    else:
-                        uri = self.ns[x.name.split(':', 1)[0]]
-                        self.write('<nsName ns="%s"/>' % uri)
-                elif x.value:
-                    if x.name == '*':
-                        self.write('<anyName>')
-                    else:
-                        uri = self.ns[x.name.split(':', 1)[0]]
-                        self.write('<nsName ns="%s">' % uri)
-                    self.visit(x.value, ctx=ctx)
-                    if x.name == '*':
-                        self.write('</anyName>')
-                    else:
-                        self.write('</nsName>')
-                else:
-                    ns = '' if ctx == 'ATTR' else self.default
-                    name = x.name
-                    if ':' in name:
-                        parts = x.name.split(':', 1)
-                        ns = self.namespace(parts[0])
-                        name = parts[1]
-                    if ns == 'inherit':
-                        self.write('<name>%s</name>' % name)
-                    else:
-                        self.write('<name ns="%s">%s</name>' % (ns, name))
-            elif x.type in set([REF, PARENT]):
-                bits = x.type.lower(), x.name, attribs
-                if not x.value: # no parameters
-                    self.write('<%s name="%s"%s/>' % bits)
-                else:
-                    self.write('<%s name="%s"%s>' % bits)
-                    self.visit(x.value)
-                    self.write('</%s>' % x.type.lower())
-            elif x.type == LITERAL:
-                types = [n.name for n in x.value if isinstance(n, parser.Node) and n.type == LITERAL_TYPE]
-                if types:
-                    assert len(types) == 1
-                    attribs += self.type_attrs(types[0])
-
-                bits = attribs, html.escape(x.name)
-
-                self.write('<value%s>%s</value>' % bits)
-                self.visit(x.value, indent=False)
-            elif x.type == ANNOTATION:
-
-                literals, rest = [], []
-                for n in x.value:
-                    if n.type == LITERAL:
-                        literals.append(n.name)
-                    elif n.type != ANNO_ATTR:
-                        rest.append(n)
-
-                end = '/' if not (literals or rest) else ''
-                tail = ''
-                if literals and not rest:
-                    tail = html.escape(''.join(literals)) + '</%s>' % x.name
-
-                bits = x.name, attribs, end, tail
-
-                if ':' in x.name:
-                    parts = x.name.split(':', 1)
-                    ns = self.namespace(parts[0])
-
-                self.write('<%s%s%s>%s' % bits)
-                if not rest:
-                    continue
-
-                for n in x.value:
-                    if n.type == ANNO_ATTR:
-                        continue
-                    elif n.type == LITERAL:
-                        self.level += 1
-                        self.write(html.escape(n.name))
-                        self.level -= 1
-                    else:
-                        self.visit([n])
-
-                self.write('</%s>' % x.name)
-
-            elif x.type == DOCUMENTATION:
-                xmlns_attr = ''
-                if self.namespace('a') != NAMESPACES['a']:
-                    xmlns_attr = ' xmlns:a="%s"' % NAMESPACES['a'] # the user is already using namespace a: for something else
-
-                fmt = '<a:documentation%s>%s</a:documentation>'
-                self.write(fmt % (xmlns_attr, html.escape('\n'.join(x.value))))
-            elif x.type == GROUP:
-                if len(x.value) == 1 and x.value[0].type != SEQ:
-                    self.visit(x.value, indent=False)
-                else:
-                    self.write('<%s>' % x.type.lower())
-                    self.visit(x.value)
-                    self.write('</%s>' % x.type.lower())
-            elif x.type == NOT_ALLOWED:
-                self.write('<notAllowed/>')
-            elif x.type in set([TEXT, EMPTY]):
-                self.write('<%s/>' % x.type.lower())
-            elif x.type == SEQ:
-                self.visit(x.value, indent=False)
-            elif x.type == DATATAG:
-                if not x.value: # no parameters
-                    self.write('<data%s/>' % self.type_attrs(x.name))
-                else:
-                    self.write('<data%s>' % self.type_attrs(x.name))
-                    self.visit(x.value)
-                    self.write('</data>')
-            elif x.type == PARAM:
-                bits = x.name, html.escape(x.value[0])
-                self.write('<param name="%s">%s</param>' % bits)
-            elif x.type == ELEM:
-                self.write('<element%s>' % attribs)
-                self.visit(x.value)
-                self.write('</element>')
-            elif x.type == ATTR:
-                self.write('<attribute%s>' % attribs)
-                self.visit(x.value, ctx=x.type)
-                self.write('</attribute>')
-            elif x.type == ROOT:
-                for n in x.value:
-                    # Record included document's custom datatypes
-                    if n.type == DATATYPES:
-                        self.typelibs[n.name] = n.value[0]
-                    
-                    # Verify the included document has the same metadata
-                    if n.type == DEFAULT_NS:
-                        assert self.default == n.value[0]
-                    elif n.type == NS:
-                        assert n.name in self.ns
-                        assert self.ns[n.name] == n.value[0]
-                self.visit(x.value, indent=False)
+            if len(self.queue) >= CHUNK_EVENTS:
+                yield self.queue
+                self.queue = []
+
+    def push(self, stack, nodes, ctx=None, close=None):
+        # schedule visiting `nodes`, followed by closing element `close`
+        if close is not None:
+            stack.append((self.end, close))
+        stack.extend(zip(reversed(nodes), itertools.repeat(ctx)))
+
+    def skip(self, x, ctx, stack):
+        pass
+
+    # Handlers read `x.value` once, since for views of flat trees that
+    # builds the list of children.
+
+    def define(self, x, ctx, stack):
+        value = x.value
+        attrs = self.anno_attrs(value)
+        for op in (n.name for n in value if n.type == ASSIGN):
+            modes = {'|=': 'choice', '&=': 'interleave'}
+            if op in modes:
+                attrs.insert(0, ('combine', modes[op]))
+            break
+
+        if x.name == 'start':
+            self.start('start', attrs)
+            self.push(stack, value, close='start')
+        else:
+            self.start('define', [('name', x.name)] + attrs)
+            self.push(stack, value, close='define')
+
+    def assign(self, x, ctx, stack):
+        self.push(stack, x.value)
+
+    def container(self, x, ctx, stack):
+        self.start(TAGS[x.type])
+        self.push(stack, x.value, ctx, close=TAGS[x.type])
+
+    def except_(self, x, ctx, stack):
+        # names in an except may inherit the namespace of an nsName, so
+        # they always get an explicit namespace
+        self.start('except')
+        ctx = ATTR_EXCEPT if ctx in ATTR_CTX else EXCEPT
+        self.push(stack, x.value, ctx, close='except')
+
+    def name(self, x, ctx, stack):
+        name, value = self.qname(x.name, ctx), x.value
+        if name.local == '*' or value:
+            # names with children are not produced by the parser; they are
+            # written like an nsName
+            if name.uri is None:
+                tag, attrs = 'anyName', []
             else:
-                assert False, x
-        if indent:
+                tag, attrs = 'nsName', [('ns', name.uri)]
+            if not value:
+                self.leaf(tag, attrs)
+            else:
+                self.start(tag, attrs)
+                self.push(stack, value, ctx, close=tag)
+        elif name.uri == 'inherit':
+            self.leaf('name', [], name.local)
+        elif self.compact and name.uri == self.default != '' and ctx not in (EXCEPT, ATTR_EXCEPT):
+            self.leaf('name', [], name.local)
+        else:
+            self.leaf('name', [('ns', name.uri)], name.local)
+
+    def ref(self, x, ctx, stack):
+        tag, value = TAGS[x.type], x.value
+        attrs = [('name', x.name)] + self.anno_attrs(value)
+        if not value: # no parameters
+            self.leaf(tag, attrs)
+        else:
+            self.start(tag, attrs)
+            self.push(stack, value, close=tag)
+
+    def literal(self, x, ctx, stack):
+        value = x.value
+        attrs = self.anno_attrs(value)
+        types = [n.name for n in value if isinstance(n, NODES) and n.type == LITERAL_TYPE]
+        if types:
+            assert len(types) == 1
+            attrs += self.type_attrs(types[0])
+
+        self.leaf('value', attrs, x.name)
+        self.push(stack, value)
+
+    def annotation(self, x, ctx, stack):
+
+        literals, rest, value = [], [], x.value
+        for n in value:
+            if n.type == LITERAL:
+                literals.append(n.name)
+            elif n.type != ANNO_ATTR:
+                rest.append(n)
+
+        tag = str(self.qname(x.name, ANNOTATION))
+        attrs = self.anno_attrs(value)
+        if not rest:
+            self.leaf(tag, attrs, ''.join(literals) if literals else None)
+            return
+
+        self.start(tag, attrs)
+        stack.append((self.end, tag))
+        for n in reversed(value):
+            if n.type == LITERAL:
+                stack.append((self.text, n.name))
+            elif n.type != ANNO_ATTR:
+                stack.append((n, None))
+
+    def documentation(self, x, ctx, stack):
+        attrs = []
+        if self.ns.get('a') != NAMESPACES['a']:
+            # the user is already using namespace a: for something else
+            attrs.append(('xmlns:a', NAMESPACES['a']))
+        self.leaf('a:documentation', attrs, '\n'.join(x.value))
+
+    def group(self, x, ctx, stack):
+        value = x.value
+        if len(value) == 1 and value[0].type != SEQ:
+            self.push(stack, value)
+        else:
+            self.container(x, ctx, stack)
+
+    def empty(self, x, ctx, stack):
+        self.leaf(TAGS[x.type])
+
+    def datatag(self, x, ctx, stack):
+        value = x.value
+        if not value: # no parameters
+            self.leaf('data', self.type_attrs(x.name))
+        else:
+            self.start('data', self.type_attrs(x.name))
+            self.push(stack, value, close='data')
+
+    def param(self, x, ctx, stack):
+        self.leaf('param', [('name', x.name)], x.value[0])
+
+    def element(self, x, ctx, stack):
+        value = x.value
+        self.start('element', self.anno_attrs(value))
+        self.push(stack, value, close='element')
+
+    def attribute(self, x, ctx, stack):
+        value = x.value
+        self.start('attribute', self.anno_attrs(value))
+        self.push(stack, value, x.type, close='attribute')
+
+    def root(self, x, ctx, stack):
+        # declarations in included documents were applied when resolving,
+        # but the names in them are looked up in the document's own scope
+        if self.resolver is not None:
+            stack.append((self.leave, self.scope))
+            self.scope = self.resolver.scopes[x, self.scope]
+        self.push(stack, x.value)
+
+    def leave(self, scope):
+        # back to the scope an included document was included from
+        self.scope = scope
+
+    HANDLERS = {
+        ANNO_ATTR: skip, LITERAL_TYPE: skip, DATATYPES: skip, DEFAULT_NS: skip, NS: skip,
+        DEFINE: define, ASSIGN: assign, GRAMMAR: container,
+        MAYBE: container, SOME: container, ANY: container,
+        INTERLEAVE: container, CHOICE: container, MIXED: container,
+        LIST: container, DIV: container, EXCEPT: except_, NAME: name,
+        REF: ref, PARENT: ref, LITERAL: literal, ANNOTATION: annotation,
+        DOCUMENTATION: documentation, GROUP: group, NOT_ALLOWED: empty,
+        TEXT: empty, EMPTY: empty, SEQ: assign, DATATAG: datatag,
+        PARAM: param, ELEM: element, ATTR: attribute, ROOT: root,
+    }
+    PLAIN_HANDLERS = dict(HANDLERS, **{ANNOTATION: skip, DOCUMENTATION: skip})
+
+def events(root, compact=False, annotations=True, simplify=False):
+    return Visitor(compact, annotations, simplify).events(root)
+
+class Writer(Visitor):
+    '''A visitor that writes XML text directly instead of generating
+    events: its chunks are lists of lines. An element is written on one
+    line if it is empty or only contains text; the content of other
+    elements is indented one level deeper, by `indent`.'''
+
+    def __init__(self, indent='  ', compact=False, annotations=True, simplify=False):
+        Visitor.__init__(self, compact, annotations, simplify)
+        self.indent = indent
+        # separator between the grammar element's attributes
+        self.attr_sep = ' ' if compact else '\n         '
+
+    def reset(self):
+        Visitor.reset(self)
+        self.queue = ['<?xml version="1.0" encoding="UTF-8"?>']
+        self.level = 0
+        self.prefix = '' # the indentation for the current level
+        self.pending = None # start tag (without '>') not written yet
+        self.pending_text = None # text right after that start tag
+
+    def flush(self):
+        # write the pending start tag, since the element has more content
+        self.queue.append(self.prefix + self.pending + '>')
+        self.level += 1
+        self.prefix = self.indent * self.level
+        if self.pending_text is not None:
+            self.queue.append(self.prefix + escape(self.pending_text))
+        self.pending = self.pending_text = None
+
+    def start(self, tag, attrs=()):
+        if self.pending is not None:
+            self.flush()
+        if self.level == 0: # the grammar element, with an attribute per line
+            attrs = self.attr_sep.join(['%s="%s"' % (k, escape(v)) for (k, v) in attrs])
+            self.queue.append('<%s %s>' % (tag, attrs))
+            self.level, self.prefix = 1, self.indent
+        elif attrs:
+            self.pending = '<' + tag + ''.join([' %s="%s"' % (k, escape(v)) for (k, v) in attrs])
+        else:
+            self.pending = '<' + tag
+
+    def end(self, tag):
+        if self.pending is None:
             self.level -= 1
+            self.prefix = self.indent * self.level
+            self.queue.append('%s</%s>' % (self.prefix, tag))
+        elif self.pending_text is None:
+            self.queue.append(self.prefix + self.pending + '/>')
+            self.pending = None
+        else:
+            text = escape(self.pending_text)
+            self.queue.append('%s%s>%s</%s>' % (self.prefix, self.pending, text, tag))
+            self.pending = self.pending_text = None
+
+    def leaf(self, tag, attrs=(), text=None):
+        if self.pending is not None:
+            self.flush()
+        if attrs:
+            tag_attrs = tag + ''.join([' %s="%s"' % (k, escape(v)) for (k, v) in attrs])
+        else:
+            tag_attrs = tag
+        if text is None:
+            self.queue.append('%s<%s/>' % (self.prefix, tag_attrs))
+        else:
+            self.queue.append('%s<%s>%s</%s>' % (self.prefix, tag_attrs, escape(text), tag))
+
+    def text(self, s):
+        if self.pending is not None and self.pending_text is None:
+            self.pending_text = s
+            return
+        elif self.pending is not None:
+            self.flush()
+        self.queue.append(self.prefix + escape(s))
+
+class XMLSerializer(object):
+    '''Serializes trees to RELAX NG XML syntax (see `Writer`, which
+    writes the same document a `Visitor` generates events for). By
+    default, the output is pretty-printed with one element per line,
+    indented by `indent`. The `compact` profile writes no indentation or
+    line breaks, and omits `datatypeLibrary` and `ns` attributes where they
+    can be inherited from the grammar element instead. Documentation and
+    annotations are left out unless `annotations` is true. With
+    `simplify`, trees are simplified first (see the `simplification`
+    module), which also leaves out annotations.'''
+
+    def __init__(self, indent=None, compact=False, annotations=True, simplify=False):
+        self.sep = '' if compact else '\n'
+        self.writer = Writer('' if compact else indent or '  ', compact, annotations, simplify)
+
+    def toxml(self, node):
+        '''Serialize the tree `node`. An instance can be shared between
+        threads.'''
+        return self.sep.join(itertools.chain.from_iterable(self.writer.chunks(node)))
+
+    def dump(self, node, f, chunk_lines=CHUNK_LINES):
+        '''Write the serialization of `node` to the file object `f`, as the
+        tree is visited, in chunks of `chunk_lines` lines. The output is the
+        same as that of `toxml()`.'''
+        lines = itertools.chain.from_iterable(self.writer.chunks(node))
+        sep = ''
+        while True:
+            chunk = list(itertools.islice(lines, chunk_lines))
+            if not chunk:
+                break
+            f.write(sep + self.sep.join(chunk))
+            sep = self.sep
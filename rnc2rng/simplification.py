@@ -0,0 +1,227 @@
+# Simplification of parsed trees, following section 4 of the RELAX NG
+# specification, so that tools loading the output do less work.
+from . import names, parser
+from .parser import (
+    ANNO_ATTR, ANNOTATION, ANY, ASSIGN, ATTR, CHOICE, DEFINE, DIV,
+    DOCUMENTATION, ELEM, EMPTY, GRAMMAR, GROUP, INTERLEAVE, LIST, MAYBE,
+    MIXED, NOT_ALLOWED, NS, PARENT, REF, ROOT, SEQ, SOME, TEXT
+)
+
+class SimplifyError(names.ResolveError):
+    '''Raised for grammars that cannot be simplified, because definitions
+    are combined in conflicting ways.'''
+
+class Simplifier(object):
+    '''Simplifies trees. Names are resolved (see the `names` module), which
+    covers the namespace and datatype library rules, and annotations are
+    left out (also from trees resolved beforehand). The remaining steps
+    are:
+
+    - divs and included documents are replaced by their contents
+    - definitions with the same name are combined into one, and those not
+      reachable from the start are removed
+    - `mixed`, `optional` and `zeroOrMore` are rewritten in terms of
+      `interleave`, `choice`, `oneOrMore`, `text` and `empty`
+    - nested groups, choices and interleaves are flattened, and those with
+      one child replaced by the child
+    - `notAllowed` and `empty` are removed or propagated where the result
+      is equivalent
+
+    Unlike in the specification, groups, choices and interleaves may have
+    more than two children, and elements are left where they are rather
+    than moved to definitions of their own. The result is a resolved tree
+    (see `names.Resolved`).'''
+
+    def simplify(self, root):
+        # Nodes are visited in post-order from an explicit stack, so that
+        # each handler gets the simplified children of its node, which may
+        # be spliced into the parent by returning a list.
+        root = names.Resolver(annotations=False).resolve(root)
+        Node, handlers = parser.Node, self.HANDLERS
+        done = {}
+        stack = [(root, False)]
+        while stack:
+            x, ready = stack.pop()
+            if not ready:
+                stack.append((x, True))
+                stack.extend((n, False) for n in x.value if isinstance(n, Node))
+                continue
+
+            value = []
+            for n in x.value:
+                if not isinstance(n, Node):
+                    value.append(n)
+                    continue
+                result = done.pop(id(n))
+                if isinstance(result, list):
+                    value.extend(result)
+                else:
+                    value.append(result)
+
+            if x is root:
+                # annotations are dropped, and so are their declarations
+                value = [n for n in value if n.type != NS or n.name not in root.anno_prefixes]
+                return names.Resolved(ROOT, None, self.grammar(value))
+            handler = handlers.get(x.type)
+            done[id(x)] = handler(self, x, value) if handler else Node(x.type, x.name, value)
+
+    def grammar(self, components):
+        # combine definitions with the same name, keeping the first position
+        first, defines = [], {}
+        for n in components:
+            if n.type != DEFINE:
+                first.append(n)
+            elif n.name in defines:
+                defines[n.name].append(n)
+            else:
+                defines[n.name] = [n]
+                first.append(n.name)
+
+        result = [n if isinstance(n, parser.Node) else self.combine(defines[n]) for n in first]
+        if 'start' not in defines:
+            return result
+        used = self.reachable(result)
+        return [n for n in result if n.type != DEFINE or n.name in used]
+
+    def combine(self, defines):
+        name = defines[0].name
+        ops = [d.value[0].name for d in defines]
+        patterns = [d.value[0].value[0] for d in defines]
+        if ops.count('=') > 1:
+            raise SimplifyError("'%s' is defined more than once without combining" % name)
+        elif '|=' in ops and '&=' in ops:
+            raise SimplifyError("'%s' is combined with both choice and interleave" % name)
+        pattern = interleave(patterns) if '&=' in ops else choice(patterns)
+        return parser.Node(DEFINE, name, [parser.Node(ASSIGN, '=', [pattern])])
+
+    def reachable(self, components):
+        # names of the definitions referenced from the start, directly or
+        # through other definitions (or from nested grammars, with parent)
+        defines = dict((n.name, n) for n in components if n.type == DEFINE)
+        used, todo = set(['start']), ['start']
+        while todo:
+            stack = [(defines[todo.pop()], 0)]
+            while stack:
+                x, depth = stack.pop()
+                if x.type == REF and depth == 0 or x.type == PARENT and depth == 1:
+                    if x.name not in used and x.name in defines:
+                        used.add(x.name)
+                        todo.append(x.name)
+                    continue
+                elif x.type == GRAMMAR:
+                    depth += 1
+                stack.extend((n, depth) for n in x.value if isinstance(n, parser.Node))
+        return used
+
+    # Handlers return the simplified form of node `x`, given its simplified
+    # children in `value`.
+
+    def splice(self, x, value):
+        return value
+
+    def drop(self, x, value):
+        return []
+
+    def nested(self, x, value):
+        return parser.Node(GRAMMAR, None, self.grammar(value))
+
+    def define(self, x, value):
+        # the pattern goes in the assignment, as made by the parser
+        ops = [n.name for n in value if n.type == ASSIGN]
+        patterns = [p for n in value for p in (n.value if n.type == ASSIGN else [n])]
+        assign = parser.Node(ASSIGN, ops[0] if ops else '=', [group(patterns)])
+        return parser.Node(DEFINE, x.name, [assign])
+
+    def group(self, x, value):
+        return group(value)
+
+    def choice(self, x, value):
+        return choice(value)
+
+    def interleave(self, x, value):
+        return interleave(value)
+
+    def optional(self, x, value):
+        return choice([parser.Node(EMPTY, None), group(value)])
+
+    def zero_or_more(self, x, value):
+        return choice([parser.Node(EMPTY, None), some(group(value))])
+
+    def one_or_more(self, x, value):
+        return some(group(value))
+
+    def mixed(self, x, value):
+        return interleave([group(value), parser.Node(TEXT, None)])
+
+    def list_(self, x, value):
+        pattern = group(value)
+        if pattern.type == NOT_ALLOWED:
+            return pattern
+        return parser.Node(LIST, None, [pattern])
+
+    def element(self, x, value):
+        return parser.Node(ELEM, None, [value[0], group(value[1:])])
+
+    def attribute(self, x, value):
+        pattern = group(value[1:]) if len(value) > 1 else parser.Node(TEXT, None)
+        if pattern.type == NOT_ALLOWED:
+            return pattern
+        return parser.Node(ATTR, None, [value[0], pattern])
+
+    HANDLERS = {
+        ROOT: splice, DIV: splice, GRAMMAR: nested, DEFINE: define,
+        SEQ: group, GROUP: group, CHOICE: choice, INTERLEAVE: interleave,
+        MAYBE: optional, ANY: zero_or_more, SOME: one_or_more, MIXED: mixed,
+        LIST: list_, ELEM: element, ATTR: attribute,
+        ANNOTATION: drop, ANNO_ATTR: drop, DOCUMENTATION: drop,
+    }
+
+def flatten(kind, patterns):
+    # the children of `patterns`, with those of nested `kind` nodes
+    result = []
+    for p in patterns:
+        if p.type == kind:
+            result.extend(p.value)
+        else:
+            result.append(p)
+    return result
+
+def group(patterns):
+    patterns = [p for p in flatten(GROUP, patterns) if p.type != EMPTY]
+    if any(p.type == NOT_ALLOWED for p in patterns):
+        return parser.Node(NOT_ALLOWED, None)
+    elif not patterns:
+        return parser.Node(EMPTY, None)
+    elif len(patterns) == 1:
+        return patterns[0]
+    return parser.Node(GROUP, None, patterns)
+
+def interleave(patterns):
+    patterns = [p for p in flatten(INTERLEAVE, patterns) if p.type != EMPTY]
+    if any(p.type == NOT_ALLOWED for p in patterns):
+        return parser.Node(NOT_ALLOWED, None)
+    elif not patterns:
+        return parser.Node(EMPTY, None)
+    elif len(patterns) == 1:
+        return patterns[0]
+    return parser.Node(INTERLEAVE, None, patterns)
+
+def choice(patterns):
+    # the empty alternative (if any) goes first
+    patterns = [p for p in flatten(CHOICE, patterns) if p.type != NOT_ALLOWED]
+    rest = [p for p in patterns if p.type != EMPTY]
+    if len(rest) < len(patterns):
+        rest.insert(0, parser.Node(EMPTY, None))
+    if not rest:
+        return parser.Node(NOT_ALLOWED, None)
+    elif len(rest) == 1:
+        return rest[0]
+    return parser.Node(CHOICE, None, rest)
+
+def some(pattern):
+    if pattern.type in (EMPTY, NOT_ALLOWED):
+        return pattern
+    return parser.Node(SOME, None, [pattern])
+
+def simplify(root):
+    return Simplifier().simplify(root)
@@ -0,0 +1,128 @@
+# Watch mode: keeps converted outputs up to date while their inputs (and
+# the files they include) are edited, reparsing only what changed.
+from . import parser, serializer
+
+import os, time
+
+def signature(fn):
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+def write_file(fn, content):
+    with open(fn, 'w') as f:
+        f.write(content)
+
+class Watcher(object):
+    '''Converts (input, output) jobs and tracks the files each input
+    includes. All parsed included trees are kept in one `parser.Includes`
+    registry across builds; when a file changes, its tree and those of
+    every file including it are dropped, and only the outputs whose
+    include closure contains it are rebuilt. Changes are detected by
+    polling file modification times and sizes. Outputs are written with
+    `write`, a function taking the file name and content, after
+    serializing them with `xml` (an `XMLSerializer`).'''
+
+    def __init__(self, fetch=None, write=None, xml=None):
+        self.includes = parser.Includes(fetch)
+        self.write = write if write is not None else write_file
+        self.xml = xml if xml is not None else serializer.XMLSerializer()
+        self.closures = {}
+        self.stats = {}
+
+    def closure(self, key):
+        seen, todo = set(), [key]
+        while todo:
+            key = todo.pop()
+            if key not in seen:
+                seen.add(key)
+                todo.extend(self.includes.edges.get(key, []))
+        return seen
+
+    def convert(self, input, xml=None):
+        '''Convert `input`, returning the XML (serialized with `xml` if
+        given). From then on, the files it includes are watched (also if
+        the conversion fails).'''
+        try:
+            root = parser.parse(f=input, includes=self.includes)
+        except Exception:
+            self.track(input, True)
+            raise
+        self.track(input, False)
+        return (xml if xml is not None else self.xml).toxml(root)
+
+    def track(self, input, failed):
+        # after a failed parse, keep watching the files included before
+        key = parser.resolve(input)
+        closure = self.closure(key) | {key}
+        if failed:
+            closure |= self.closures.get(input, set())
+        self.closures[input] = closure
+        for fn in closure:
+            if fn not in self.stats and not parser.is_url(fn):
+                self.stats[fn] = signature(fn)
+
+    def build(self, input, output):
+        '''Convert `input` to `output`; returns the time taken and an error
+        message (or None).'''
+        start, error = time.time(), None
+        try:
+            xml = self.convert(input)
+            os.makedirs(os.path.dirname(output) or os.curdir, exist_ok=True)
+            self.write(output, xml + '\n')
+        except parser.ParseError as e:
+            error = 'parse error ' + e.msg
+        except (IOError, OSError, ValueError) as e:
+            error = '%s: %s' % (type(e).__name__, e)
+        return time.time() - start, error
+
+    def changed(self):
+        changed = set()
+        for fn, sig in list(self.stats.items()):
+            new = signature(fn)
+            if new != sig:
+                self.stats[fn] = new
+                changed.add(fn)
+        return changed
+
+    def invalidate(self, changed):
+        parents = {}
+        for key, children in self.includes.edges.items():
+            for child in children:
+                parents.setdefault(child, set()).add(key)
+        seen, todo = set(), list(changed)
+        while todo:
+            key = todo.pop()
+            if key not in seen:
+                seen.add(key)
+                self.includes.trees.pop(key, None)
+                self.includes.edges.pop(key, None)
+                todo.extend(parents.get(key, ()))
+
+    def update(self, jobs):
+        '''Bring the outputs for `jobs` up to date: build new jobs and those
+        affected by changed files. Returns (input, seconds, error) for each
+        job built.'''
+        changed = self.changed()
+        stale = set(fn for (fn, closure) in self.closures.items() if closure & changed)
+        self.invalidate(changed)
+
+        results = []
+        current = set()
+        for input, output in jobs:
+            current.add(input)
+            if input in stale or input not in self.closures:
+                results.append((input,) + self.build(input, output))
+        for input in set(self.closures) - current:
+            del self.closures[input]
+        return results
+
+    def watch(self, jobs, report, interval=0.5):
+        '''Keep updating until interrupted; `jobs` is a function returning
+        the current list of jobs, `report` is called with each result.'''
+        while True:
+            for result in self.update(jobs()):
+                report(*result)
+            time.sleep(interval)
@@ -23,6 +23,7 @@ setup(
         'Programming Language :: Python :: 3.12',
     ],
     packages=['rnc2rng'],
+    package_data={'rnc2rng': ['parsetab.json']},
     entry_points={
         'console_scripts': [
             'rnc2rng = rnc2rng.__main__:main',
@@ -1,6 +1,8 @@
 import rnc2rng
-import unittest, os
-import sys
+from rnc2rng import binary, daemon, hashcons, names, parser, rnctree, serializer, simplification
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import unittest, asyncio, concurrent.futures, io, json, os, shutil, subprocess, tempfile, threading
+import random, struct, sys
 if sys.version_info[0] < 3:
     from urllib import pathname2url, url2pathname
     from urlparse import urljoin, urlparse
@@ -8,6 +10,11 @@ else:
     from urllib.parse import urljoin, urlparse
     from urllib.request import pathname2url, url2pathname
 
+def fixtures():
+    '''The paths of the schemas in the tests directory, in order.'''
+    for fn in sorted(os.listdir('tests')):
+        if fn.endswith('.rnc'):
+            yield os.path.join('tests', fn)
 
 class TestUtils(unittest.TestCase):
     def assertBestEqual(self, expected, actual):
@@ -49,6 +56,784 @@ class APITests(TestUtils):
         actual = rnc2rng.dumps(rnc2rng.loads(src)).strip()
         self.assertBestEqual(expected, actual)
 
+    def test_parse_error(self):
+        src = 'start = element foo {\n\ttext text\n}'
+        with self.assertRaises(parser.ParseError) as cm:
+            rnc2rng.loads(src)
+        self.assertEqual(cm.exception.location, (None, 1, 6))
+        self.assertEqual(cm.exception.msg, 'in (unknown) [2:7]\n    text text\n         ^')
+        with self.assertRaises(parser.ParseError) as cm:
+            rnc2rng.loads(src.replace('\n', '\r\n'))
+        self.assertEqual(cm.exception.line, '\ttext text')
+        with self.assertRaises(parser.ParseError) as cm:
+            rnc2rng.loads('start = element foo {\n  text\n')
+        self.assertEqual(cm.exception.location, (None, 1, 6))
+        with self.assertRaises(parser.ParseError) as cm:
+            rnc2rng.loads('start = element foo {\n  "text\n}')
+        self.assertEqual(cm.exception.location, (None, 1, 2))
+
+    def test_lex(self):
+        src = 'default namespace = "x" # comment\nstart |= a:b ~ \\element'
+        tokens = [(t.name, t.value, t.source_pos.lineno, t.source_pos.colno)
+                  for t in parser.lex(src)]
+        self.assertEqual(tokens, [
+            ('DEFAULT', 'default', 1, 1), ('NAMESPACE', 'namespace', 1, 9),
+            ('EQUAL', '=', 1, 19), ('LITERAL', 'x', 1, 21),
+            ('START', 'start', 2, 1), ('COMBINE', '|=', 2, 7),
+            ('CNAME', 'a:b', 2, 10), ('TILDE', '~', 2, 14),
+            ('QID', '\\element', 2, 16),
+        ])
+
+    def test_scaling(self):
+        n = 10000
+        defines = ''.join('d%s = element e%s { empty }\n' % (i, i) for i in range(n))
+        choice = ' | '.join('"v%s"' % i for i in range(n))
+        docs = ''.join('## line %s\n' % i for i in range(n))
+        concat = ' ~ '.join('"%s"' % (i % 10) for i in range(n))
+        src = defines + docs + 'start = element a { %s }\nx = %s' % (choice, concat)
+        root = rnc2rng.loads(src)
+        self.assertEqual([n.name for n in root.value[:n]], ['d%s' % i for i in range(n)])
+        start, concat = root.value[n:]
+        doc, assign = start.value
+        self.assertEqual(doc.value, ['line %s' % i for i in range(n)])
+        values = assign.value[0].value[1].value
+        self.assertEqual([v.name for v in values], ['v%s' % i for i in range(n)])
+        value = ''.join(str(i % 10) for i in range(n))
+        self.assertEqual(concat.value[0].value[0].name, value)
+
+    def write_files(self, files):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        for fn, src in files.items():
+            with open(os.path.join(tmp, fn), 'w') as f:
+                f.write(src)
+        return tmp
+
+    def test_include_once(self):
+        tmp = self.write_files({
+            'a.rnc': 'include "b.rnc"\ninclude "c.rnc"\nstart = element a { D }\n',
+            'b.rnc': 'include "d.rnc"\n',
+            'c.rnc': 'include "d.rnc"\n',
+            'd.rnc': 'D = element d { empty }\n',
+        })
+        includes = parser.Includes()
+        root = parser.parse(f=os.path.join(tmp, 'a.rnc'), includes=includes)
+        self.assertEqual(sorted(os.path.basename(k) for k in includes.trees),
+                         ['b.rnc', 'c.rnc', 'd.rnc'])
+        b, c = root.value[0].value[0], root.value[1].value[0]
+        self.assertIs(b.value[0], c.value[0])
+        self.assertEqual(rnc2rng.dumps(root).count('<define name="D">'), 2)
+
+    def test_parallel_load(self):
+        tmp = self.write_files({
+            'a.rnc': 'include "b.rnc"\n## docs\ninclude "c.rnc"\nstart = element a { D }\n',
+            'b.rnc': 'include "d.rnc"\ndiv { include "features.rnc" }\n',
+            'c.rnc': 'grammar { include "d.rnc" start = D }\n',
+            'd.rnc': 'D = element d { empty }\n',
+        })
+        shutil.copy('tests/features.rnc', tmp)
+        fn = os.path.join(tmp, 'a.rnc')
+        expected = rnc2rng.dumps(rnc2rng.load(fn))
+        self.assertBestEqual(expected, rnc2rng.dumps(rnc2rng.load(fn, workers=2)))
+
+    def test_include_cycle(self):
+        tmp = self.write_files({
+            'a.rnc': 'include "b.rnc"\nstart = element a { empty }\n',
+            'b.rnc': 'include "c.rnc"\n',
+            'c.rnc': 'D = element d { empty }\ninclude "b.rnc"\n',
+        })
+        with self.assertRaises(parser.IncludeCycleError) as cm:
+            rnc2rng.load(os.path.join(tmp, 'a.rnc'))
+        with self.assertRaises(parser.IncludeCycleError):
+            rnc2rng.load(os.path.join(tmp, 'a.rnc'), workers=2)
+        chain = [os.path.basename(fn) for fn in cm.exception.chain]
+        self.assertEqual(chain, ['b.rnc', 'c.rnc', 'b.rnc'])
+        self.assertEqual(cm.exception.location[1:], (1, 0))
+        self.assertTrue(cm.exception.msg.startswith('include cycle: '))
+
+    def test_disk_cache(self):
+        tmp = self.write_files({
+            'a.rnc': 'include "b.rnc"\nstart = element a { B }\n',
+            'b.rnc': 'B = element b { empty }\n',
+        })
+        fn, cache_dir = os.path.join(tmp, 'a.rnc'), os.path.join(tmp, 'cache')
+        disk = rnc2rng.cache.DiskCache(cache_dir)
+        self.assertIsNone(disk.get(fn))
+        expected = rnc2rng.dumps(rnc2rng.load(fn))
+        self.assertBestEqual(expected, rnc2rng.dumps(rnc2rng.load(fn, cache_dir=cache_dir)))
+        self.assertBestEqual(expected, rnc2rng.dumps(disk.get(fn)))
+
+        # changing an included file invalidates the entry
+        with open(os.path.join(tmp, 'b.rnc'), 'w') as f:
+            f.write('B = element c { empty }\n')
+        self.assertIsNone(disk.get(fn))
+        actual = rnc2rng.dumps(rnc2rng.load(fn, cache_dir=cache_dir))
+        self.assertIn('<name ns="">c</name>', actual)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        # entries hold no pickles, and unreadable entries are ignored
+        entry, = os.listdir(cache_dir)
+        with open(os.path.join(cache_dir, entry), 'rb') as f:
+            header = json.loads(f.readline().decode('utf-8'))
+        b = os.path.join(tmp, 'b.rnc')
+        self.assertEqual(header['deps'], [[parser.resolve(b), parser.digest(parser.read(b))]])
+        with open(os.path.join(cache_dir, entry), 'rb') as f:
+            data = f.read()
+        rng = random.Random(0)
+        for i in range(200):
+            corrupt = bytearray(data)
+            corrupt[rng.randrange(len(corrupt))] = rng.randrange(256)
+            with open(os.path.join(cache_dir, entry), 'wb') as f:
+                f.write(corrupt)
+            root = disk.get(fn) # a miss, or a hit if only JSON spacing changed
+            if root is not None:
+                self.assertEqual(rnc2rng.dumps(root), actual)
+        with open(os.path.join(cache_dir, entry), 'wb') as f:
+            f.write(b'{"deps": [], "tree": ""}\ngarbage')
+        self.assertIsNone(disk.get(fn))
+
+        # evicting goes below the maximum size, not just to it
+        disk = rnc2rng.cache.DiskCache(cache_dir, max_size=1)
+        self.assertIsNotNone(disk.load(fn))
+        self.assertEqual(disk.size, 0)
+        self.assertEqual(os.listdir(cache_dir), [])
+
+    def test_memory_cache(self):
+        with open('tests/features.rnc') as f:
+            src = f.read()
+        memo = rnc2rng.MemoryCache(max_entries=2)
+        expected = rnc2rng.dumps(rnc2rng.loads(src))
+        root = rnc2rng.loads(src, cache=memo)
+        self.assertBestEqual(expected, rnc2rng.dumps(root, cache=memo))
+        root.value[:] = [] # mutating results does not affect the cache
+        root = rnc2rng.loads(src, cache=memo)
+        self.assertBestEqual(expected, rnc2rng.dumps(root, cache=memo))
+        self.assertEqual(memo.stats(), {
+            'hits': 2, 'misses': 2, 'entries': 2, 'size': memo.size,
+        })
+        # other trees are serialized, but not cached
+        self.assertBestEqual(expected, rnc2rng.dumps(rnc2rng.loads(src), cache=memo))
+        self.assertEqual(memo.stats()['hits'] + memo.stats()['misses'], 4)
+
+        rnc2rng.load('tests/include.rnc', cache=memo)
+        self.assertEqual(len(memo.entries), 2)
+        include = os.path.realpath('tests/include.rnc')
+        self.assertEqual(list(memo.entries)[-1][:2], ('load', include))
+
+        memo = rnc2rng.MemoryCache(max_size=0)
+        rnc2rng.loads(src, cache=memo)
+        self.assertEqual((len(memo.entries), memo.size), (0, 0))
+
+    def test_concurrent(self):
+        # hundreds of conversions in threads, sharing the parser, one
+        # serializer and one cache, must give the same results as serially
+        files = list(fixtures())
+        expected = dict((fn, rnc2rng.dumps(rnc2rng.load(fn))) for fn in files)
+        xml = serializer.XMLSerializer()
+        memo = rnc2rng.MemoryCache(max_entries=4)
+
+        def convert(i):
+            fn = files[i % len(files)]
+            if i % 3 == 0:
+                return fn, xml.toxml(rnc2rng.load(fn))
+            elif i % 3 == 1:
+                return fn, rnc2rng.dumps(rnc2rng.load(fn, cache=memo), cache=memo)
+            with open(fn, 'rb') as f:
+                src = parser.decode(f.read())
+            if src.startswith('include') or '\ninclude' in src:
+                return fn, xml.toxml(rnc2rng.load(fn))
+            return fn, rnctree.make_nodetree(rnctree.token_list(src)).toxml()
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-5) # switch threads often to provoke races
+        self.addCleanup(sys.setswitchinterval, interval)
+        with concurrent.futures.ThreadPoolExecutor(16) as pool:
+            results = list(pool.map(convert, range(400)))
+        self.assertEqual(len(results), 400)
+        for fn, output in results:
+            self.assertEqual(output, expected[fn], fn)
+
+    def test_dump_streaming(self):
+        class Chunks(list):
+            write = list.append
+        for fn in fixtures():
+            root = rnc2rng.load(fn)
+            chunks = Chunks()
+            serializer.XMLSerializer().dump(root, chunks, chunk_lines=4)
+            self.assertEqual(''.join(chunks), rnc2rng.dumps(root), fn)
+            buf = io.StringIO()
+            rnc2rng.dump(root, buf)
+            self.assertEqual(buf.getvalue(), rnc2rng.dumps(root), fn)
+        self.assertGreater(len(chunks), 2)
+
+    def test_dump_memory(self):
+        # names are resolved without copying the tree, so dumping only
+        # takes memory for the names and the chunk being written
+        import tracemalloc
+
+        class Null(object):
+            def write(self, s):
+                pass
+        define = 'd%d = element e%d { attribute id { xsd:ID }, (text | d%d)* }\n'
+        src = 'start = d0\n' + ''.join(define % (i, i, (i + 1) % 5000) for i in range(5000))
+        tracemalloc.start()
+        root = rnc2rng.loads(src)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        # a new trace only counts what dumping allocates
+        tracemalloc.start()
+        try:
+            rnc2rng.dump(root, Null())
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, size / 3)
+
+    def test_compact(self):
+        import xml.etree.ElementTree as ET
+
+        def resolve(xml):
+            # elements with their inherited ns and datatypeLibrary applied
+            out, stack = [], [(ET.fromstring(xml), '', '')]
+            while stack:
+                elem, ns, lib = stack.pop()
+                attrs = dict(elem.attrib)
+                ns = attrs.pop('ns', ns)
+                lib = attrs.pop('datatypeLibrary', lib)
+                text = (elem.text or '').strip()
+                out.append((elem.tag, sorted(attrs.items()), ns, lib, text))
+                stack.extend((child, ns, lib) for child in reversed(elem))
+            return out
+
+        for fn in fixtures():
+            root = rnc2rng.load(fn)
+            xml = rnc2rng.dumps(root, compact=True)
+            self.assertNotIn('>\n', xml)
+            self.assertEqual(resolve(xml), resolve(rnc2rng.dumps(root)), fn)
+            buf = io.StringIO()
+            rnc2rng.dump(root, buf, compact=True)
+            self.assertEqual(buf.getvalue(), xml)
+
+            plain = rnc2rng.dumps(root, compact=True, annotations=False)
+            self.assertNotIn('<a:documentation', plain)
+            self.assertNotIn('<sch:', plain)
+
+    def test_events(self):
+        root = rnc2rng.loads('## doc\nstart |= element a { xsd:string { maxLength = "3" } }\n')
+        self.assertEqual(list(rnc2rng.events(root)), [
+            ('start', 'grammar', [
+                ('xmlns', 'http://relaxng.org/ns/structure/1.0'),
+                ('xmlns:a', 'http://relaxng.org/ns/compatibility/annotations/1.0'),
+                ('datatypeLibrary', 'http://www.w3.org/2001/XMLSchema-datatypes'),
+            ]),
+            ('start', 'start', [('combine', 'choice')]),
+            ('start', 'a:documentation', []), ('text', 'doc'), ('end', 'a:documentation'),
+            ('start', 'element', []),
+            ('start', 'name', [('ns', '')]), ('text', 'a'), ('end', 'name'),
+            ('start', 'data', [('type', 'string')]),
+            ('start', 'param', [('name', 'maxLength')]), ('text', '3'), ('end', 'param'),
+            ('end', 'data'),
+            ('end', 'element'),
+            ('end', 'start'),
+            ('end', 'grammar'),
+        ])
+
+        # start and end events nest properly
+        for fn in fixtures():
+            tags = []
+            for event in rnc2rng.events(rnc2rng.load(fn)):
+                if event[0] == 'start':
+                    tags.append(event[1])
+                elif event[0] == 'end':
+                    self.assertEqual(tags.pop(), event[1])
+            self.assertEqual(tags, [])
+
+    def test_to_etree(self):
+        import xml.etree.ElementTree as ET
+
+        def strip(elem):
+            for e in elem.iter():
+                e.text = (e.text or '').strip() or None
+                e.tail = None
+            return ET.tostring(elem)
+
+        for fn in fixtures():
+            root = rnc2rng.load(fn)
+            expected = strip(ET.fromstring(rnc2rng.dumps(root)))
+            self.assertEqual(strip(rnc2rng.to_etree(root)), expected, fn)
+            plain = strip(ET.fromstring(rnc2rng.dumps(root, annotations=False)))
+            self.assertEqual(strip(rnc2rng.to_etree(root, annotations=False)), plain, fn)
+
+    def test_resolve_names(self):
+        src = 'default namespace = "urn:d"\nnamespace x = "urn:x"\n' \
+              'start = element a {\n' \
+              '  attribute (b | x:c) { xsd:int }, element x:* - d { empty }\n' \
+              '}\n'
+        root = rnc2rng.loads(src)
+        resolved = rnc2rng.resolve_names(root)
+        found = [n.name for n in resolved.value[-1].value[0].value[0].value if n.type == 'NAME']
+        self.assertEqual(found, [('urn:d', 'a', None)])
+        self.assertIs(rnc2rng.resolve_names(resolved), resolved)
+        self.assertEqual(rnc2rng.dumps(resolved), rnc2rng.dumps(root))
+        # unprefixed names in a name class choice of an attribute are in no namespace
+        self.assertIn('<name ns="">b</name>', rnc2rng.dumps(root))
+
+        # the annotations option applies to trees resolved beforehand, and
+        # leaves out the prefixes only declared for annotations
+        root = rnc2rng.load(os.path.join('tests', 'documentation.rnc'))
+        resolved = rnc2rng.resolve_names(root)
+        for annotations in (True, False):
+            self.assertEqual(rnc2rng.dumps(resolved, annotations=annotations),
+                             rnc2rng.dumps(root, annotations=annotations))
+        self.assertNotIn('xmlns:a', rnc2rng.dumps(resolved, annotations=False))
+        self.assertEqual(rnc2rng.dumps(rnc2rng.simplify(resolved)),
+                         rnc2rng.dumps(rnc2rng.simplify(root)))
+
+        # identical names share an instance
+        src = 'start = element a { element a { empty } }'
+        resolved = rnc2rng.resolve_names(rnc2rng.loads(src))
+        outer = resolved.value[-1].value[0].value[0]
+        self.assertIs(outer.value[0].name, outer.value[1].value[0].name)
+
+        # errors point at the first use of the prefix, and are raised
+        # before the first event
+        errors = [
+            ('start = element x:a { empty }',
+             "undeclared namespace prefix 'x' in name 'x:a'", 16),
+            ('start = element a { x:int }',
+             "undeclared datatypes prefix 'x' in datatype 'x:int'", 20),
+        ]
+        for src, msg, col in errors:
+            with self.assertRaises(names.ResolveError) as cm:
+                rnc2rng.dumps(rnc2rng.loads(src))
+            self.assertEqual(cm.exception.msg.splitlines(), [
+                msg, 'in (unknown) [1:%d]' % (col + 1), src, ' ' * col + '^'
+            ])
+            self.assertEqual(cm.exception.location, (None, 0, col))
+            with self.assertRaises(names.ResolveError):
+                next(rnc2rng.events(rnc2rng.loads(src)))
+            # only offsets are recorded while parsing
+            self.assertEqual(list(rnc2rng.loads(src).prefixes.values()), [col])
+
+        # a prefix must be bound to the same namespace in included files
+        included = rnc2rng.loads('namespace x = "urn:y"\nstart = empty')
+        root = rnc2rng.loads('namespace x = "urn:x"\nstart = element x:a { empty }')
+        root.value.append(included)
+        with self.assertRaises(names.ResolveError) as cm:
+            rnc2rng.resolve_names(root)
+        msg = "namespace prefix 'x' declared as both 'urn:x' and 'urn:y'"
+        self.assertEqual(cm.exception.msg.splitlines()[0], msg)
+        self.assertEqual(cm.exception.location, (None, 0, 0))
+        included = parser.Node('ROOT', None, [parser.Node('NS', 'x', ['urn:y'])])
+        root.value[-1] = included
+        with self.assertRaises(names.ResolveError) as cm:
+            rnc2rng.dumps(root)
+        self.assertEqual(cm.exception.msg, msg) # no location for trees built by hand
+
+    def test_intern(self):
+        for fn in fixtures():
+            interned = rnc2rng.load(fn, intern=True)
+            self.assertEqual(rnc2rng.dumps(interned), rnc2rng.dumps(rnc2rng.load(fn)), fn)
+
+        src = 'start = element a {' \
+              ' element b { text }, element c { text, xsd:string }, xsd:string }'
+        interner = hashcons.Interner()
+        root = rnc2rng.loads(src, intern=interner)
+        b, c, string = root.value[0].value[0].value[0].value[1].value
+        self.assertIs(b.value[1], c.value[1].value[0]) # text
+        self.assertIs(c.value[1].value[1], string)
+        self.assertEqual(interner.stats(), {'nodes': 15, 'shared': 2, 'distinct': 13})
+
+        # trees interned with the same interner share subtrees
+        other = rnc2rng.loads('start = element x { text }', intern=interner)
+        self.assertIs(other.value[0].value[0].value[0].value[1], b.value[1])
+
+    def test_flat(self):
+        for fn in fixtures():
+            root = rnc2rng.load(fn)
+            tree = rnc2rng.flatten(root)
+            self.assertEqual(rnc2rng.dumps(tree), rnc2rng.dumps(root), fn)
+            compact = rnc2rng.dumps(root, compact=True)
+            self.assertEqual(rnc2rng.dumps(tree, compact=True), compact, fn)
+            self.assertEqual(list(rnc2rng.events(tree)), list(rnc2rng.events(root)), fn)
+            self.assertEqual(repr(tree.to_node()), repr(root), fn)
+
+        root = rnc2rng.loads('start = element a { attribute b { "c" }, empty }')
+        tree = rnc2rng.flatten(root)
+        self.assertEqual(len(tree), 10)
+        elem = tree.root.value[0].value[0].value[0]
+        self.assertEqual((elem.type, elem.name), ('ELEM', None))
+        self.assertEqual([n.type for n in elem.children()], ['NAME', 'SEQ'])
+        literal = elem.value[1].value[0].value[1]
+        self.assertEqual((literal.type, literal.name, literal.value), ('LITERAL', 'c', []))
+        self.assertEqual(repr(literal.to_node()), repr(parser.Node('LITERAL', 'c')))
+
+        # trees with shared subtrees are flattened to a copy of each
+        shared = rnc2rng.loads('start = element a { text } | element b { text }', intern=True)
+        self.assertEqual(rnc2rng.dumps(rnc2rng.flatten(shared)), rnc2rng.dumps(shared))
+
+    def test_simplify(self):
+        src = '\n'.join([
+            'start = a | b*',
+            'a = element a {',
+            '  (text, empty)?, mixed { b }, (notAllowed | c), (text, (text | notAllowed))',
+            '}',
+            'a |= element a2 { empty }',
+            'div { b = list { token* } }',
+            'c = attribute c { xsd:int } & (empty & empty)',
+            'unused = element u { text }',
+        ])
+        xml = rnc2rng.dumps(rnc2rng.simplify(rnc2rng.loads(src)), compact=True)
+        expected = (
+            '<start><choice><empty/><ref name="a"/>'
+            '<oneOrMore><ref name="b"/></oneOrMore></choice></start>'
+            '<define name="a"><choice>'
+            '<element><name ns="">a</name><group>'
+            '<choice><empty/><text/></choice>'
+            '<interleave><ref name="b"/><text/></interleave>'
+            '<ref name="c"/><text/><text/>'
+            '</group></element>'
+            '<element><name ns="">a2</name><empty/></element>'
+            '</choice></define>'
+            '<define name="b"><list><choice><empty/><oneOrMore>'
+            '<data type="token"/>'
+            '</oneOrMore></choice></list></define>'
+            '<define name="c"><attribute><name ns="">c</name>'
+            '<data type="int" datatypeLibrary="http://www.w3.org/2001/XMLSchema-datatypes"/>'
+            '</attribute></define>'
+        )
+        self.assertEqual(xml[xml.index('<start>'):-len('</grammar>')], expected)
+
+        # the same through the serializer option, and simplifying is idempotent
+        root = rnc2rng.loads(src)
+        xml = serializer.XMLSerializer(simplify=True).toxml(root)
+        self.assertEqual(xml, rnc2rng.dumps(rnc2rng.simplify(root)))
+        twice = rnc2rng.simplify(rnc2rng.simplify(root))
+        self.assertEqual(rnc2rng.dumps(twice), rnc2rng.dumps(rnc2rng.simplify(root)))
+
+        # names keep the namespaces of their included document
+        root = rnc2rng.loads('start = element a { b }')
+        included = rnc2rng.loads('default namespace = "urn:x"\nb = element b { empty }')
+        root.value.append(included)
+        self.assertIn('<name ns="urn:x">b</name>', rnc2rng.dumps(rnc2rng.simplify(root)))
+
+        # annotations are left out of trees resolved beforehand as well
+        root = rnc2rng.resolve_names(rnc2rng.load(os.path.join('tests', 'documentation.rnc')))
+        for xml in (rnc2rng.dumps(rnc2rng.simplify(root)),
+                    serializer.XMLSerializer(simplify=True).toxml(root)):
+            self.assertNotIn('documentation', xml)
+            self.assertIn('<element>\n      <name ns="">lang</name>', xml)
+
+        errors = [
+            ('start = a\na = empty\na = text', "'a' is defined more than once without combining"),
+            ('start = a\na |= empty\na &= text',
+             "'a' is combined with both choice and interleave"),
+        ]
+        for src, msg in errors:
+            with self.assertRaises(simplification.SimplifyError) as cm:
+                rnc2rng.simplify(rnc2rng.loads(src))
+            self.assertEqual(cm.exception.msg, msg)
+
+    def test_serialize_deep(self):
+        # the serializer does not recurse, so depth is not limited
+        depth = sys.getrecursionlimit() * 2
+        node = parser.Node('EMPTY', None)
+        for i in range(depth):
+            node = parser.Node('ELEM', None, [parser.Node('NAME', 'e'), node])
+        start = parser.Node('DEFINE', 'start', [parser.Node('ASSIGN', '='), node])
+        xml = serializer.XMLSerializer(' ').toxml(parser.Node('ROOT', None, [start]))
+        lines = xml.splitlines()
+        self.assertEqual(lines.count('%s<empty/>' % (' ' * (depth + 2))), 1)
+        self.assertEqual(lines[-3:], ['  </element>', ' </start>', '</grammar>'])
+
+    def test_ast_roundtrip(self):
+        for fn in fixtures():
+            root = rnc2rng.load(fn)
+            buf = io.BytesIO()
+            rnc2rng.dump_ast(root, buf)
+            buf.seek(0)
+            self.assertBestEqual(rnc2rng.dumps(root), rnc2rng.dumps(rnc2rng.load_ast(buf)))
+        with self.assertRaises(ValueError):
+            rnc2rng.load_ast(io.BytesIO(b'<?xml version="1.0"?>'))
+
+        # malformed data raises ValueError, whatever is wrong with it
+        root = rnc2rng.loads('start = element a { xsd:int }')
+        data = binary.dumps(root)
+        for n in range(len(data)):
+            with self.assertRaises(ValueError):
+                binary.loads(data[:n])
+        # the type, name and count of the first item (all one byte columns)
+        size = len(rnc2rng.flatten(root))
+        first = [len(data) - k * (size + 1) + 1 for k in (3, 2, 1)]
+        for i in first:
+            corrupt = bytearray(data)
+            corrupt[i] = 255
+            with self.assertRaises(ValueError):
+                binary.loads(bytes(corrupt))
+        # data written with other node types is rejected
+        corrupt = data[:8] + struct.pack('<I', binary.TYPES_CRC ^ 1) + data[12:]
+        with self.assertRaises(ValueError):
+            binary.loads(corrupt)
+
+    def serve(self, protocol='HTTP/1.0'):
+        # serve the test files over HTTP, logging (path, status, client port)
+        log = []
+
+        class Handler(SimpleHTTPRequestHandler):
+            protocol_version = protocol
+
+            def __init__(self, *args, **kwargs):
+                SimpleHTTPRequestHandler.__init__(self, *args, directory='tests', **kwargs)
+
+            def log_request(self, code='-', size='-'):
+                log.append((self.path, int(code), self.client_address[1]))
+
+            def log_error(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return 'http://127.0.0.1:%s/' % server.server_address[1], log, server
+
+    def test_aload(self):
+        base, log, server = self.serve()
+        url = base + 'include.rnc'
+        root = asyncio.run(rnc2rng.aload(url, limit=2))
+        requests = sorted(path for (path, code, port) in log)
+        self.assertEqual(requests, ['/datatypes.rnc', '/include.rnc', '/simple.rnc'])
+        with open('tests/include.rng') as f:
+            expected = f.read().rstrip()
+        self.assertBestEqual(expected, rnc2rng.dumps(root).strip())
+        self.assertBestEqual(rnc2rng.dumps(rnc2rng.load(url)), rnc2rng.dumps(root))
+
+    def test_fetcher(self):
+        base, log, server = self.serve('HTTP/1.1')
+        url, tmp = base + 'include.rnc', self.write_files({})
+        fetcher = rnc2rng.Fetcher(os.path.join(tmp, 'http'))
+        self.addCleanup(fetcher.close)
+        expected = rnc2rng.dumps(rnc2rng.load(url))
+        self.assertBestEqual(expected, rnc2rng.dumps(rnc2rng.load(url, fetch=fetcher)))
+        self.assertEqual([code for (path, code, port) in log[-3:]], [200, 200, 200])
+        self.assertEqual(len(set(port for (path, code, port) in log[-3:])), 1)
+
+        # revalidated with If-Modified-Since the second time around
+        self.assertBestEqual(expected, rnc2rng.dumps(rnc2rng.load(url, fetch=fetcher)))
+        self.assertEqual([code for (path, code, port) in log[-3:]], [304, 304, 304])
+
+        offline = rnc2rng.Fetcher(os.path.join(tmp, 'http'), offline=True)
+        n = len(log)
+        self.assertBestEqual(expected, rnc2rng.dumps(rnc2rng.load(url, fetch=offline)))
+        self.assertEqual(len(log), n)
+        with self.assertRaises(IOError):
+            offline(base + 'features.rnc')
+
+        # requests for other hosts go through the proxy (the test server,
+        # which cannot serve them, but logs the full URL it was sent)
+        proxied = rnc2rng.Fetcher(proxies={'http': base})
+        self.addCleanup(proxied.close)
+        with self.assertRaises(IOError):
+            proxied('http://rnc2rng.invalid/simple.rnc')
+        self.assertEqual(log[-1][:2], ('http://rnc2rng.invalid/simple.rnc', 404))
+
+    def test_batch(self):
+        tmp = self.write_files({'broken.rnc': 'start = element a { text text }'})
+        os.mkdir(os.path.join(tmp, 'sub'))
+        for fn in ('features.rnc', 'include.rnc', 'datatypes.rnc', 'simple.rnc'):
+            shutil.copy(os.path.join('tests', fn), os.path.join(tmp, 'sub'))
+        out = os.path.join(tmp, 'out')
+        cmd = [sys.executable, '-m', 'rnc2rng', '-j', '2', '--out-dir', out, tmp]
+        proc = subprocess.run(cmd, stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(proc.returncode, 1)
+        self.assertIn('broken.rnc: parse error', proc.stderr)
+        self.assertIn('4 converted, 1 failed in ', proc.stderr)
+        for fn in ('features.rng', 'include.rng', 'datatypes.rng', 'simple.rng'):
+            with open(os.path.join('tests', fn)) as f:
+                expected = f.read().rstrip()
+            with open(os.path.join(out, 'sub', fn)) as f:
+                self.assertBestEqual(expected, f.read().rstrip())
+
+        # files with the same name would overwrite each other's output
+        shutil.copy(os.path.join('tests', 'simple.rnc'), tmp)
+        inputs = [os.path.join(tmp, 'simple.rnc'), os.path.join(tmp, 'sub', 'simple.rnc')]
+        cmd = [sys.executable, '-m', 'rnc2rng', '--out-dir', os.path.join(tmp, 'flat')]
+        proc = subprocess.run(cmd + inputs, stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(proc.returncode, 1)
+        self.assertIn('%s: output file ' % inputs[0], proc.stderr)
+        self.assertIn('0 converted, 2 failed in ', proc.stderr)
+        self.assertFalse(os.path.exists(os.path.join(tmp, 'flat')))
+
+        proc = subprocess.run(cmd + ['-j', '-1'] + inputs, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+        self.assertEqual(proc.returncode, 2)
+        self.assertIn('must be 0 (one per CPU) or more', proc.stderr)
+
+    def test_watch(self):
+        tmp = self.write_files({
+            'a.rnc': 'include "b.rnc"\ninclude "c.rnc"\nstart = element a { B | C }\n',
+            'b.rnc': 'include "d.rnc"\nB = element b { D }\n',
+            'c.rnc': 'C = element c { empty }\n',
+            'd.rnc': 'D = element d { empty }\n',
+            'e.rnc': 'include "c.rnc"\nstart = C\n',
+        })
+        path = lambda fn: os.path.join(tmp, fn)
+        jobs = [(path('a.rnc'), path('a.rng')), (path('e.rnc'), path('e.rng'))]
+        watcher = rnc2rng.watch.Watcher()
+        built = [fn for (fn, secs, error) in watcher.update(jobs)]
+        self.assertEqual(built, [path('a.rnc'), path('e.rnc')])
+        self.assertEqual(watcher.update(jobs), [])
+
+        c = watcher.includes.trees[os.path.realpath(path('c.rnc'))]
+        with open(path('d.rnc'), 'w') as f:
+            f.write('D = element dd { empty }\n')
+        built = [(fn, error) for (fn, secs, error) in watcher.update(jobs)]
+        self.assertEqual(built, [(path('a.rnc'), None)])
+        self.assertIs(watcher.includes.trees[os.path.realpath(path('c.rnc'))], c)
+        with open(path('a.rng')) as f:
+            self.assertIn('<name ns="">dd</name>', f.read())
+
+        with open(path('c.rnc'), 'w') as f:
+            f.write('C = element c {')
+        built = [(fn, error is None) for (fn, secs, error) in watcher.update(jobs)]
+        self.assertEqual(built, [(path('a.rnc'), False), (path('e.rnc'), False)])
+
+        # lexing errors are reported like other parse errors
+        with open(path('c.rnc'), 'w') as f:
+            f.write('C = element c { "empty }\n')
+        built = [(fn, error) for (fn, secs, error) in watcher.update(jobs)]
+        self.assertEqual([fn for (fn, error) in built], [path('a.rnc'), path('e.rnc')])
+        self.assertTrue(built[0][1].startswith('parse error in %s [1:17]' % path('c.rnc')))
+
+    def test_depfile(self):
+        tmp = self.write_files({})
+        out, dep = os.path.join(tmp, 'out.rng'), os.path.join(tmp, 'out.d')
+        cmd = [sys.executable, '-m', 'rnc2rng', '-M', dep, '--skip-unchanged',
+               'tests/include.rnc', out]
+        for cache in ([], ['--cache-dir', os.path.join(tmp, 'cache')]):
+            subprocess.check_call(cmd + cache)
+            with open(dep) as f:
+                rules = f.read().splitlines()
+            deps = [os.path.realpath(os.path.join('tests', fn))
+                    for fn in ('include.rnc', 'datatypes.rnc', 'simple.rnc')]
+            self.assertEqual(rules[0], '%s: %s' % (out, ' '.join(deps)))
+            self.assertEqual(sorted(rules[1:]), sorted('%s:' % fn for fn in deps[1:]))
+
+        os.utime(out, (0, 0))
+        subprocess.check_call(cmd)
+        self.assertEqual(os.stat(out).st_mtime, 0)
+
+        for opts in (['--watch'], ['--out-dir', tmp]):
+            proc = subprocess.run(cmd + opts, stderr=subprocess.PIPE, universal_newlines=True)
+            self.assertEqual(proc.returncode, 2)
+            self.assertIn('--depfile cannot be used with', proc.stderr)
+
+    @unittest.skipUnless(daemon.UNIX, 'Unix sockets are not supported')
+    def test_daemon(self):
+        tmp = self.write_files({
+            'a.rnc': 'include "b.rnc"\nstart = element a { B }\n',
+            'b.rnc': 'B = element b { empty }\n',
+            'bad.rnc': 'start = element a {',
+        })
+        path = lambda fn: os.path.join(tmp, fn)
+        address = path('daemon.sock')
+        self.assertIsNone(daemon.connect(address))
+        expected = rnc2rng.dumps(rnc2rng.load(path('a.rnc')))
+        self.assertEqual(daemon.convert(address, path('a.rnc')), expected)
+
+        server = daemon.make_server(address)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.assertEqual(os.stat(address).st_mode & 0o777, 0o600)
+        self.assertEqual(daemon.convert(address, path('a.rnc')), expected)
+        b = server.watcher.includes.trees[os.path.realpath(path('b.rnc'))]
+        self.assertEqual(daemon.convert(address, path('a.rnc')), expected)
+        self.assertIs(server.watcher.includes.trees[os.path.realpath(path('b.rnc'))], b)
+
+        with open(path('b.rnc'), 'w') as f:
+            f.write('B = element bb { empty }\n')
+        self.assertIn('<name ns="">bb</name>', daemon.convert(address, path('a.rnc')))
+        with self.assertRaises(daemon.ConversionError) as cm:
+            daemon.convert(address, path('bad.rnc'))
+        self.assertTrue(cm.exception.msg.startswith('parse error '))
+
+        cmd = [sys.executable, '-m', 'rnc2rng', '--daemon', address, path('a.rnc')]
+        self.assertIn('<name ns="">bb</name>', subprocess.check_output(cmd).decode('utf-8'))
+        self.assertEqual(server.watcher.closures[path('a.rnc')], set(
+            os.path.realpath(path(fn)) for fn in ('a.rnc', 'b.rnc')
+        ))
+
+        # caching options are passed on to the daemon
+        cache_dir = path('cache')
+        subprocess.check_call(cmd + ['--cache-dir', cache_dir, '--offline'],
+                              stdout=subprocess.DEVNULL)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        self.assertEqual(sorted(server.watchers), [(None, False), (None, True)])
+
+    def test_daemon_tcp(self):
+        for spec in ('0.0.0.0:8000', 'example.com:8000'):
+            with self.assertRaises(ValueError):
+                daemon.address(spec)
+        self.assertEqual(daemon.address('localhost:8000'), ('localhost', 8000))
+
+        # the token file is written to the home directory
+        home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, home)
+        self.addCleanup(os.environ.__setitem__, 'HOME', os.environ['HOME'])
+        os.environ['HOME'] = home
+
+        server = daemon.make_server('127.0.0.1:0')
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        address = '127.0.0.1:%d' % server.server_address[1]
+        self.assertEqual(os.stat(server.token_file).st_mode & 0o777, 0o600)
+        expected = rnc2rng.dumps(rnc2rng.load('tests/include.rnc'))
+        self.assertEqual(daemon.convert(address, 'tests/include.rnc'), expected)
+
+        # other users can connect, but can't read the token
+        for token in (None, 'wrong', 1):
+            request = {'input': os.path.abspath('tests/include.rnc')}
+            if token is not None:
+                request['token'] = token
+            with daemon.connect(address) as sock, sock.makefile('rwb') as f:
+                daemon.send(f, request)
+                self.assertEqual(daemon.receive(f), {'error': 'missing or wrong daemon token'})
+                self.assertIsNone(daemon.receive(f))
+        # without a token file, conversions don't use the daemon
+        os.unlink(server.token_file)
+        fallback = lambda fn: 'in-process'
+        self.assertEqual(daemon.convert(address, 'tests/include.rnc', fallback=fallback),
+                         'in-process')
+        self.assertIn(os.path.realpath('tests/include.rnc'), server.watcher.closures[
+            os.path.abspath('tests/include.rnc')
+        ])
+
+        cmd = [sys.executable, '-m', 'rnc2rng', '--daemon', '0.0.0.0:1', 'tests/include.rnc']
+        proc = subprocess.run(cmd, stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(proc.returncode, 2)
+        self.assertIn('not on the loopback interface', proc.stderr)
+
+    def test_parser_tables(self):
+        # shipped tables must match the grammar; regenerate them with
+        # rnc2rng.parser.write_tables() after changing any production
+        g = parser.build_grammar()
+        with open(parser.TABLES) as f:
+            data = json.load(f)
+        self.assertEqual(data['hash'], parser.pg.compute_grammar_hash(g))
+        self.assertTrue(parser.pg.data_is_valid(g, data))
+
+    def test_parser_tables_fallback(self):
+        fallback = parser.build(os.path.join('tests', 'missing.json'))
+        with open('tests/features.rnc') as f:
+            src = f.read()
+        expected = rnc2rng.dumps(rnc2rng.loads(src))
+        root = fallback.parse(parser.lex(src), state=parser.State(None, src))
+        self.assertBestEqual(expected, rnc2rng.dumps(root))
+
 
 def suite():
     suite = unittest.TestLoader().loadTestsFromTestCase(APITests)